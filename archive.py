@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+# An append-only record of the API responses a crawl received, so the
+# database can be rebuilt from it without going back to GitHub.
+#
+# Each crawler process writes its responses as JSON lines to its own
+# segment-<writer>-00000.jsonl.gz, segment-<writer>-00001.jsonl.gz, ...
+# with each line compressed as its own gzip member, so a segment is an
+# ordinary gzipped JSONL file but any one response can be read by seeking
+# to it. index-<writer>.jsonl records where each response is and, for
+# /repositories pages, the range of repository ids on the page, for file
+# contents the blob's SHA and for GraphQL queries the repos they asked
+# about. Readers merge the indexes of every writer.
+
+import os
+import re
+import json
+import glob
+import gzip
+import time
+import zlib
+import fcntl
+import socket
+import hashlib
+import threading
+from StringIO import StringIO
+from urlparse import urlparse
+
+import requests
+
+SEGMENT_SIZE = 256 * 1024 * 1024
+
+# The reason given on the 504s standing in for requests the crawl never made
+NOT_RECORDED = 'Not in archive'
+
+graphql_repo_re = re.compile(r'(\w+): repository\(owner: ("(?:[^"\\]|\\.)*"), '
+                             r'name: ("(?:[^"\\]|\\.)*")\)')
+
+
+def request_key(url, data=None):
+    # POSTs (GraphQL queries) share a URL, so their body is part of the key
+    if data is None:
+        return url
+
+    return "%s#%s" % (url, hashlib.sha1(json.dumps(data, sort_keys=True))
+                      .hexdigest())
+
+
+class ArchiveLocked(Exception):
+    pass
+
+
+def writer_name():
+    # Unique to this process, and safe in a file name
+    return "%s-%s" % (socket.gethostname().replace('/', '_'), os.getpid())
+
+
+def segment_name(writer, segment):
+    return "segment-%s-%05d.jsonl.gz" % (writer, segment)
+
+
+def gzip_member(text):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(text)
+    f.close()
+
+    return buf.getvalue()
+
+
+def listed_ids(url, body):
+    # (first id, last id) of a non-empty /repositories page, else None
+    if not urlparse(url).path.endswith('/repositories'):
+        return None
+
+    try:
+        repos_json = json.loads(body)
+    except ValueError:
+        return None
+
+    if not isinstance(repos_json, list) or not repos_json:
+        return None
+
+    return repos_json[0]['id'], repos_json[-1]['id']
+
+
+def file_sha(url, body):
+    # The blob SHA of a file's /contents/ (or /readme) response, else None
+    path = urlparse(url).path
+
+    if not '/contents/' in path and not path.endswith('/readme'):
+        return None
+
+    try:
+        file_json = json.loads(body)
+    except ValueError:
+        return None
+
+    if not isinstance(file_json, dict) or file_json.get('type') != 'file' \
+            or file_json.get('content') is None:
+        return None
+
+    return file_json.get('sha')
+
+
+def queried_repos(data):
+    # [[alias, full name], ...] for the repos a GraphQL query asks about
+    if not isinstance(data, dict) or not 'query' in data:
+        return []
+
+    return [[alias, "%s/%s" % (json.loads(owner), json.loads(name))]
+            for alias, owner, name in graphql_repo_re.findall(data['query'])]
+
+
+class ArchiveWriter(object):
+    """
+    Appends responses to the archive in `path` under this process's own
+    files, so any number of crawler processes can share the directory.
+    Safe to share between worker threads. Raises ArchiveLocked if another
+    process has the same files open.
+    """
+
+    def __init__(self, path, writer=None, segment_size=SEGMENT_SIZE):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.writer = writer or writer_name()
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+
+        self.index = open(os.path.join(path, "index-%s.jsonl" % self.writer),
+                          'a')
+
+        try:
+            fcntl.flock(self.index, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.index.close()
+            raise ArchiveLocked("Archive files for %s in %s are in use" % \
+                                    (self.writer, path))
+
+        # Carry on from our last segment if we've written here before
+        segments = sorted(glob.glob(os.path.join(
+            path, "segment-%s-%s.jsonl.gz" % (self.writer, '[0-9]' * 5))))
+        self.segment = int(segments[-1][-14:-9]) if segments else 0
+
+        self.f = None
+        self.open_segment()
+
+    def open_segment(self):
+        if self.f:
+            self.f.close()
+
+        self.f = open(os.path.join(self.path, segment_name(self.writer,
+                                                           self.segment)),
+                      'ab')
+        self.f.seek(0, os.SEEK_END)
+
+    def record(self, url, r, data=None):
+        body = r.text
+        entry = {'url': url,
+                 'data': data,
+                 'status': r.status_code,
+                 'headers': dict(r.headers),
+                 'body': body,
+                 'at': time.time()}
+
+        member = gzip_member(json.dumps(entry) + "\n")
+        ids = listed_ids(url, body) if r.ok and data is None else None
+        sha = file_sha(url, body) if r.ok and data is None else None
+        repos = queried_repos(data) if r.ok else []
+
+        with self.lock:
+            if self.f.tell() + len(member) > self.segment_size and \
+                    self.f.tell() > 0:
+                self.segment = self.segment + 1
+                self.open_segment()
+
+            offset = self.f.tell()
+            self.f.write(member)
+            self.f.flush()
+
+            # Only index a response once it's fully written
+            index_entry = {'key': request_key(url, data),
+                           'segment': segment_name(self.writer,
+                                                   self.segment),
+                           'offset': offset,
+                           'length': len(member),
+                           'at': entry['at']}
+
+            if ids:
+                index_entry['first_id'], index_entry['last_id'] = ids
+            if sha:
+                index_entry['sha'] = sha
+            if repos:
+                index_entry['repos'] = repos
+
+            self.index.write(json.dumps(index_entry) + "\n")
+            self.index.flush()
+
+    def close(self):
+        self.f.close()
+        self.index.close()
+
+
+class ArchiveReader(object):
+    """
+    Serves responses out of an archive by URL, through the indexes of
+    all its writers. Where a request was recorded more than once the
+    latest response wins. File contents can also be looked up by blob SHA
+    and GraphQL results by repo, since which requests a crawl makes
+    depends on what its database already had.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.blobs = {}
+        self.graphql_repos = {}
+        self.pages = []
+        self.files = {}
+        self.lock = threading.Lock()
+
+        recorded_at = {}
+        queried_at = {}
+
+        for index_path in sorted(glob.glob(os.path.join(path,
+                                                        'index-*.jsonl'))):
+            f = open(index_path, 'r')
+
+            for line in f:
+                # A crawl that died mid-write can leave a partial last line
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+
+                key = entry['key']
+                location = (entry['segment'], entry['offset'],
+                            entry['length'])
+
+                if recorded_at.get(key, 0) <= entry['at']:
+                    recorded_at[key] = entry['at']
+                    self.entries[key] = location
+
+                # Any copy of a blob will do
+                if 'sha' in entry:
+                    self.blobs.setdefault(entry['sha'], location)
+
+                for alias, full_name in entry.get('repos', []):
+                    if queried_at.get(full_name, 0) <= entry['at']:
+                        queried_at[full_name] = entry['at']
+                        self.graphql_repos[full_name] = (location, alias)
+
+                if 'first_id' in entry:
+                    self.pages.append((entry['first_id'], entry['last_id'],
+                                       key))
+
+            f.close()
+
+        # Each page once, even if several writers listed it
+        self.pages = sorted(set(self.pages))
+
+    def read(self, key):
+        # The recorded entry for a request key, or None
+        if not key in self.entries:
+            return None
+
+        return self.read_at(self.entries[key])
+
+    def read_at(self, location):
+        segment, offset, length = location
+
+        with self.lock:
+            if not segment in self.files:
+                self.files[segment] = open(os.path.join(self.path, segment),
+                                           'rb')
+
+            f = self.files[segment]
+            f.seek(offset)
+            member = f.read(length)
+
+        return json.loads(zlib.decompress(member, 16 + zlib.MAX_WBITS))
+
+    def recorded(self, url, data=None):
+        return request_key(url, data) in self.entries
+
+    def blob_content(self, sha):
+        # The base64 content of any recorded copy of a blob, or None
+        if not sha in self.blobs:
+            return None
+
+        return json.loads(self.read_at(self.blobs[sha])['body'])['content']
+
+    def graphql_entry(self, url, data):
+        # A GraphQL query the crawl didn't make as such, put together from
+        # the results for its repos in the queries it did make. None
+        # unless every repo was asked about.
+        repos = queried_repos(data)
+
+        if not repos or [full_name for alias, full_name in repos
+                         if not full_name in self.graphql_repos]:
+            return None
+
+        bodies = {}
+        result = {}
+
+        for alias, full_name in repos:
+            location, recorded_alias = self.graphql_repos[full_name]
+
+            if not location in bodies:
+                bodies[location] = json.loads(self.read_at(location)['body'])
+
+            result[alias] = bodies[location]['data'].get(recorded_alias)
+
+        return {'status': 200, 'headers': {},
+                'body': json.dumps({'data': result})}
+
+    def response(self, url, data=None):
+        # The recorded response as a requests.Response. Requests the crawl
+        # never made come back as 504s with reason NOT_RECORDED, which the
+        # crawler treats as a failed fetch to retry later.
+        entry = self.read(request_key(url, data))
+
+        if entry is None and data is not None:
+            entry = self.graphql_entry(url, data)
+
+        r = requests.Response()
+        r.url = url
+        r.encoding = 'utf-8'
+
+        if entry is None:
+            r.status_code = 504
+            r.reason = NOT_RECORDED
+            r._content = ""
+        else:
+            r.status_code = entry['status']
+            r.headers = requests.structures.CaseInsensitiveDict(
+                entry['headers'])
+            r._content = entry['body'].encode('utf-8')
+
+        return r
+
+    def list_pages(self, start_id=None, end_id=None):
+        # Yield (repos, next_url, done) for the recorded /repositories pages
+        # in id order, like ghretrieve.list_pages, keeping only repos with
+        # ids in (start_id, end_id]. Pages listed more than once (after a
+        # restart, say) only contribute each repo once.
+        pages = [page for page in self.pages
+                 if (start_id is None or page[1] > start_id) and
+                 (end_id is None or page[0] <= end_id)]
+        last_id = start_id
+
+        for i, (first_id, page_last_id, key) in enumerate(pages):
+            repos_json = json.loads(self.read(key)['body'])
+            repos_json = [repo for repo in repos_json
+                          if (last_id is None or repo['id'] > last_id) and
+                          (end_id is None or repo['id'] <= end_id)]
+
+            if repos_json:
+                last_id = repos_json[-1]['id']
+
+            yield repos_json, None, i == len(pages) - 1
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# Checks the rule engine in rules.py against the normalization and
+# mapping it replaced (sanitize_license_list and the variant join in
+# map_repos_to_licenses), on random nomos-style results, and times both.
+#
+#   python benchmark/bench_rules.py -n 200000
+#
+# Exits 1 if any result differs.
+
+import os
+import re
+import sys
+import time
+import random
+import optparse
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_path, '..'))
+
+import rules
+
+# Abbreviations nomos reports, including the ones the rules look at
+ABBRS = ['MIT', 'MIT-style', 'BSD-style', 'BSD-3-Clause', 'BSD-2-Clause',
+         'Apache-2.0', 'Apache-possibility', 'GPL', 'GPL-2.0', 'GPL-2.0+',
+         'GPL-3.0', 'GPL-3.0+', 'LGPL-2.1', 'LGPL-2.1+', 'LGPL-3.0',
+         'AGPL-3.0', 'Affero', 'FSF', 'Public-domain', 'Ruby', 'Artistic',
+         'Artistic-2.0', 'ISC', 'MPL-2.0', 'EPL-1.0', 'CC-BY-4.0',
+         'X11-style', 'Zlib', 'WTFPL', 'Unlicense', 'UnclassifiedLicense',
+         'Dual-license', 'Python-possibility', 'CDDL']
+
+# What the licenses table knows about
+KNOWN = ['MIT', 'BSD', 'BSD-3-Clause', 'BSD-2-Clause', 'Apache',
+         'Apache-2.0', 'GPL', 'GPL-2.0', 'GPL-3.0', 'LGPL-2.1', 'LGPL-3.0',
+         'AGPL-3.0', 'Ruby', 'Artistic', 'ISC', 'MPL-2.0', 'EPL-1.0',
+         'X11-style', 'Zlib', 'Unlicense', 'Public-domain', 'CDDL']
+
+
+# The functions rules.py replaced, as they were
+
+def legacy_sanitize_license_list(license_list):
+
+    # Find all the licenses we want to filter for
+    ruby_i = list_search(license_list, "Ruby")
+    pd_i = list_search(license_list, "Public-domain")
+    mit_i = list_search(license_list, "MIT")
+    mit_style_i = list_search(license_list, "MIT-style")
+    artistic_i = list_search(license_list, "Artistic")
+    fsf_i = list_search(license_list, "FSF")
+    gpl_i = list_substring_search(license_list, "GPL")
+    agpl_i = list_substring_search(license_list, "Affero")
+
+    # All "MIT" and "MIT-style" should just be "MIT"
+    if mit_i > -1 and mit_style_i > -1:
+        license_list.remove("MIT-style")
+    elif mit_style_i > -1:
+        license_list[mit_style_i] = "MIT"
+
+    # "Public domain" match for Ruby, Artistic & GPL(s) are usually
+    # false positives
+    if pd_i > -1 and (agpl_i > -1 or gpl_i > -1 \
+                      or ruby_i > -1 or artistic_i > -1):
+        license_list.remove("Public-domain")
+
+    # "FSF" match for GPL not needed
+    if gpl_i > -1 and fsf_i > -1:
+        license_list.remove("FSF")
+
+    return license_list
+
+
+def list_search(alist, value):
+    try:
+        i = alist.index(value)
+    except:
+        i = -1
+
+    return i
+
+
+def list_substring_search(alist, search_substring):
+    for item in alist:
+        if re.search(search_substring, item):
+            return alist.index(item)
+
+    return -1
+
+
+def legacy_license_id(abbr, license_ids):
+    # map_repos_to_licenses' COALESCE(variant, exact) join
+    if abbr == 'No_license_found':
+        return None
+
+    m = re.match('^(.*)-(style|possibility)', abbr)
+
+    if m and m.group(1) in license_ids:
+        return license_ids[m.group(1)]
+
+    return license_ids.get(abbr)
+
+
+def random_results(n, seed=0):
+    # nomos reports each license once per file
+    rand = random.Random(seed)
+    results = []
+
+    for i in range(n):
+        size = rand.choice([1, 1, 1, 2, 2, 3, 4, 6])
+        results.append(rand.sample(ABBRS, size))
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('-n', '--results',
+                      action="store", dest="results", type="int",
+                      help="""Number of random license lists""",
+                      default=100000)
+
+    options, args = parser.parse_args()
+
+    results = random_results(options.results)
+    license_ids = dict([(abbr, i + 1) for i, abbr in enumerate(KNOWN)])
+
+    start = time.time()
+    legacy = [legacy_sanitize_license_list(list(r)) for r in results]
+    legacy_time = time.time() - start
+
+    engine = rules.RuleEngine(license_ids=license_ids)
+
+    start = time.time()
+    normalized = engine.normalize_batch(results)
+    engine_time = time.time() - start
+
+    mismatches = [(r, a, b) for r, a, b in zip(results, legacy, normalized)
+                  if a != b]
+
+    for raw, expected, got in mismatches[:10]:
+        print('%s: sanitize_license_list %s, rules %s' % (raw, expected, got))
+
+    abbrs = ABBRS + ['No_license_found']
+    legacy_map = dict([(abbr, legacy_license_id(abbr, license_ids))
+                       for abbr in abbrs if abbr != 'No_license_found'])
+    engine_map = engine.map_abbrs(abbrs)
+
+    for abbr in sorted(legacy_map):
+        if legacy_map[abbr] != engine_map.get(abbr):
+            mismatches.append(abbr)
+            print('%s: mapped to %s, rules %s' % \
+                      (abbr, legacy_map[abbr], engine_map.get(abbr)))
+
+    print('%-24s %10.0f lists/sec' % ('sanitize_license_list',
+                                      len(results) / legacy_time))
+    print('%-24s %10.0f lists/sec' % ('rules.normalize_batch',
+                                      len(results) / engine_time))
+
+    if mismatches:
+        print('%s results differ' % len(mismatches))
+        sys.exit(1)
+
+    print('All %s results and %s mappings identical' % \
+              (len(results), len(legacy_map)))
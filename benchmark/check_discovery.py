@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Checks that ghretrieve's GraphQL discovery finds the same license files
+# as the REST contents walk, on a synthetic corpus served by the stub
+# API. Blob text over --truncate bytes comes back truncated, and text
+# with a byte order mark comes back without it, so the contents API
+# fallback for files GraphQL can't return exactly is exercised too.
+#
+#   python benchmark/check_discovery.py -n 500
+#
+# Files are compared as the rows db_writer would store for them. Exits 1
+# if any repo differs.
+
+import os
+import sys
+import logging
+import optparse
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_path, '..'))
+
+import corpus
+import stub_server
+import credentials
+import db_writer
+import ghretrieve
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def setup(server, concurrency=1):
+    ghretrieve.config = {}
+    ghretrieve.logger = logger
+    ghretrieve.api_url = server.base_url
+    ghretrieve.scheduler = credentials.CredentialScheduler(
+        credentials.load_credentials({}))
+    ghretrieve.init_session(max(10, concurrency))
+
+
+def discover(repos, discovery, concurrency=1):
+    # repo id -> sorted repository_licenses rows, or False if the fetch
+    # failed
+    ghretrieve.discovery = discovery
+    ghretrieve.known_shas = set()
+
+    results = ghretrieve.get_licenses_for_repos(repos, concurrency)
+
+    return dict([(repo['id'], licenses is not None and
+                  sorted([db_writer.license_row(repo['id'], alicense)
+                          for alicense in licenses.values()]))
+                 for repo, licenses in zip(repos, results)])
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('-n', '--repos',
+                      action="store", dest="repos", type="int",
+                      help="""Number of synthetic repos""",
+                      default=500)
+
+    parser.add_option('--truncate',
+                      action="store", dest="truncate", type="int",
+                      help="""Size in bytes above which the stub truncates
+                              GraphQL blob text""",
+                      default=3000)
+
+    parser.add_option('-c', '--concurrency',
+                      action="store", dest="concurrency", type="int",
+                      help="""Fetch concurrency""",
+                      default=4)
+
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    server = stub_server.StubServer(corpus.generate(options.repos),
+                                    truncate=options.truncate)
+    server.start()
+    setup(server, options.concurrency)
+
+    repos = []
+
+    for page, next_url, done in ghretrieve.list_pages(
+            "%s/repositories" % server.base_url):
+        repos.extend(page)
+
+    contents = discover(repos, 'contents', options.concurrency)
+    graphql = discover(repos, 'graphql', options.concurrency)
+
+    mismatches = [repo['id'] for repo in repos
+                  if contents[repo['id']] != graphql[repo['id']]]
+
+    for repo_id in mismatches[:10]:
+        print('Repository #%s: contents %s, graphql %s' % \
+                  (repo_id, contents[repo_id], graphql[repo_id]))
+
+    files = sum([len(rows or []) for rows in contents.values()])
+
+    if mismatches:
+        print('%s of %s repositories differ' % (len(mismatches), len(repos)))
+        sys.exit(1)
+
+    counters = metrics.snapshot()['counters']
+
+    print('%s license files in %s repositories identical (%s fetched '\
+          'through the contents API fallback, %s of them because the '\
+          'GraphQL text didn\'t match the blob SHA)' % \
+              (files, len(repos), counters.get('crawl.graphql_fallback', 0),
+               counters.get('crawl.graphql_mismatch', 0)))
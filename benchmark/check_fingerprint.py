@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Checks the fingerprint classifier (license_id.py -e fingerprint) on the
+# license files of a synthetic corpus, against reference texts for the
+# corpus licenses, and times it. BSD-2-Clause's reference is part of
+# BSD-3-Clause's, so BSD-3-Clause files must not report it too; files
+# with two licenses appended must report both. The same files then go
+# through license_id's -x cross-check against the fake nomos.
+#
+#   python benchmark/check_fingerprint.py -n 1000
+#
+# Needs numpy. Exits 1 if any file is misclassified or the engines
+# disagree.
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import optparse
+import tempfile
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_path, '..'))
+
+import corpus
+import fingerprint
+import license_id
+
+logger = logging.getLogger(__name__)
+
+# Reference name -> the license whose reference text it's the start of
+CONTAINED = {'BSD-2-Clause': 'BSD-3-Clause'}
+
+
+def write_references(path):
+    # One reference text per corpus license, without a copyright line
+    for abbr in corpus.LICENSES:
+        f = open(os.path.join(path, "%s.txt" % abbr), 'w')
+        f.write(reference_text(abbr))
+        f.close()
+
+    for abbr, container in CONTAINED.items():
+        paragraphs = reference_text(container).split("\n\n")
+
+        f = open(os.path.join(path, "%s.txt" % abbr), 'w')
+        f.write("\n\n".join(paragraphs[:-1]) + "\n")
+        f.close()
+
+
+def reference_text(abbr):
+    text = corpus.license_text(abbr, 'holder', 2000, None)
+
+    return "\n".join([line for line in text.split("\n")
+                      if not line.startswith('Copyright')])
+
+
+def license_jobs(repos, dual=50, seed=0):
+    # (key, name, text) for each distinct license file in the corpus, and
+    # `dual` files with two licenses, with the licenses each should match
+    jobs = []
+    expected = {}
+
+    for repo in repos:
+        for name in sorted(repo['files']):
+            content = repo['files'][name]
+            key = ('sha', corpus.git_sha(content))
+
+            if not name in corpus.LICENSE_FILENAMES or key in expected:
+                continue
+
+            jobs.append((key, name, content))
+            expected[key] = [repo['license']]
+
+    rng = random.Random(seed)
+
+    for i in range(dual):
+        abbrs = rng.sample(corpus.LICENSES, 2)
+        content = "\n\n".join([corpus.license_text(abbr, "holder%s" % i,
+                                                   2010, rng)
+                               for abbr in abbrs])
+        key = ('dual', i)
+
+        jobs.append((key, 'LICENSE', content))
+        expected[key] = abbrs
+
+    return jobs, expected
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('-n', '--repos',
+                      action="store", dest="repos", type="int",
+                      help="""Number of synthetic repos""",
+                      default=1000)
+
+    parser.add_option('--threshold',
+                      action="store", dest="threshold", type="float",
+                      help="""Fingerprint match threshold""",
+                      default=0.8)
+
+    parser.add_option('-b', '--batch_size',
+                      action="store", dest="batch_size", type="int",
+                      help="""Files per nomos invocation in the
+                              cross-check""",
+                      default=50)
+
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    reference_path = tempfile.mkdtemp(prefix='fingerprint_refs')
+    base_path = tempfile.mkdtemp(prefix='fingerprint_check')
+
+    write_references(reference_path)
+    classifier = fingerprint.FingerprintClassifier(reference_path,
+                                                   options.threshold)
+    jobs, expected = license_jobs(corpus.generate(options.repos))
+
+    start = time.time()
+    found = dict([(key, classifier.classify(text.decode('utf-8', 'replace')))
+                  for key, name, text in jobs])
+    elapsed = time.time() - start
+
+    wrong = [key for key, name, text in jobs
+             if sorted(found[key]) != sorted(expected[key])]
+
+    for key in wrong[:10]:
+        print('%s: expected %s, classified as %s' % \
+                  (key, ", ".join(expected[key]), ", ".join(found[key])))
+
+    print('Classified %s of %s license files correctly (%.0f files/sec, '\
+          '%s references)' % (len(jobs) - len(wrong), len(jobs),
+                              len(jobs) / max(elapsed, 1e-6),
+                              len(classifier.abbrs)))
+
+    # The -x cross-check, with the fake nomos
+    license_id.config = {'nomos_path': os.path.join(bench_path,
+                                                    'fake_nomos.py'),
+                         'nomos_timeout': 300}
+    license_id.logger = logger
+    license_id.classifier = classifier
+    license_id.init_scan_worker(base_path)
+
+    agree, nomos_only, fingerprint_only = \
+        license_id.compare_engines(jobs, options.batch_size)
+
+    print('Engines agree on %s of %s files' % (agree, len(jobs)))
+
+    for abbr in sorted(set(nomos_only.keys() + fingerprint_only.keys())):
+        print('%s: %s only found by nomos, %s only by fingerprint' % \
+                  (abbr, nomos_only.get(abbr, 0), fingerprint_only.get(abbr, 0)))
+
+    shutil.rmtree(reference_path)
+    shutil.rmtree(base_path)
+
+    if wrong or agree < len(jobs):
+        sys.exit(1)
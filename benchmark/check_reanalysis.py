@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# Checks that re-analysis keeps the repo license mappings and
+# license_repo_counts right when a file's licenses change. Files are
+# stored, scanned with the fake nomos and mapped, then a rules change
+# turns MIT into ISC and license_id.py --reanalyze_stale and -a run
+# again. Needs a scratch database created with db_setup.py; its tables
+# are TRUNCATED.
+#
+#   python benchmark/check_reanalysis.py --database "dbname=scratch"
+#
+# Exits 1 if the mappings or counts are wrong.
+
+import os
+import sys
+import shutil
+import logging
+import optparse
+import tempfile
+from base64 import b64encode
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_path, '..'))
+
+import psycopg2
+import corpus
+import rules
+import db_writer
+import license_id
+
+logger = logging.getLogger(__name__)
+
+LICENSES = ['MIT', 'ISC', 'Apache-2.0']
+
+# Repo id -> the licenses of its files
+REPOS = {1: ['MIT'],
+         2: ['MIT', 'Apache-2.0'],
+         3: ['Apache-2.0']}
+
+
+def api_repo(repo_id):
+    return {'id': repo_id, 'owner': {'login': 'owner'},
+            'name': "repo%s" % repo_id, 'full_name': "owner/repo%s" % repo_id,
+            'description': None, 'private': False, 'fork': False,
+            'url': "https://api.github.com/repos/owner/repo%s" % repo_id,
+            'html_url': "https://github.com/owner/repo%s" % repo_id}
+
+
+def api_license(repo_id, abbr, i):
+    name = "LICENSE-%s" % i
+    content = corpus.license_text(abbr, "holder%s" % repo_id, 2010, None)
+
+    return {'type': 'file', 'encoding': 'base64', 'name': name,
+            'path': name, 'size': len(content), 'content': b64encode(content),
+            'sha': corpus.git_sha(content),
+            '_links': {'self': name, 'html': name}}
+
+
+def mappings(cur):
+    # repo id -> sorted abbreviations it's mapped to
+    cur.execute("""SELECT r.gh_id, c.license_abbr
+                     FROM repository_license_abbr a
+                     JOIN repositories r
+                       ON r.id = a.repository_id
+                     JOIN licenses c
+                       ON c.id = a.license_abbr_id
+                 ORDER BY r.gh_id, c.license_abbr""")
+    mapped = {}
+
+    for repo_id, abbr in cur.fetchall():
+        mapped.setdefault(repo_id, []).append(abbr)
+
+    return mapped
+
+
+def counts(cur):
+    # abbreviation -> repos in license_repo_counts, leaving out zeros
+    cur.execute("""SELECT c.license_abbr, n.repos
+                     FROM license_repo_counts n
+                     JOIN licenses c
+                       ON c.id = n.license_abbr_id
+                    WHERE n.repos > 0""")
+
+    return dict(cur.fetchall())
+
+
+def check(cur, stage, expected):
+    # Report how the mappings and counts differ from what the repos'
+    # licenses should give. Returns True if they don't.
+    expected_counts = {}
+
+    for abbrs in expected.values():
+        for abbr in abbrs:
+            expected_counts[abbr] = expected_counts.get(abbr, 0) + 1
+
+    found, found_counts = mappings(cur), counts(cur)
+    ok = found == expected and found_counts == expected_counts
+
+    print('%s: mappings %s, counts %s%s' % \
+              (stage, found, found_counts,
+               '' if ok else ' (expected %s, %s)' % (expected,
+                                                    expected_counts)))
+
+    return ok
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('--database',
+                      action="store", dest="database",
+                      help="""psycopg2 DSN of a scratch database created
+                              with db_setup.py; its tables are TRUNCATED""",
+                      default="")
+
+    options, args = parser.parse_args()
+
+    if not options.database:
+        parser.error("--database is required")
+
+    logging.basicConfig(level=logging.ERROR)
+
+    db_conn = psycopg2.connect(options.database)
+    cur = db_conn.cursor()
+    cur.execute("""TRUNCATE repositories, license_blobs, licenses,
+                            repository_counts CASCADE""")
+
+    for abbr in LICENSES:
+        cur.execute("""INSERT INTO licenses(license_abbr, name)
+                            VALUES (%s, %s)""", (abbr, abbr))
+
+    db_conn.commit()
+
+    writer = db_writer.PageWriter(db_conn)
+    writer.store_repos([api_repo(repo_id) for repo_id in sorted(REPOS)])
+
+    for repo_id, abbrs in sorted(REPOS.items()):
+        for i, abbr in enumerate(abbrs):
+            writer.add_license(repo_id, api_license(repo_id, abbr, i))
+
+    writer.flush()
+
+    export_path = tempfile.mkdtemp(prefix='reanalysis_check')
+
+    license_id.config = {'export_directory': os.path.join(export_path,
+                                                          'licenses'),
+                         'nomos_path': os.path.join(bench_path,
+                                                    'fake_nomos.py')}
+    license_id.logger = logger
+    license_id.db_conn = db_conn
+    license_id.cur = cur
+
+    license_id.process_licenses()
+    license_id.map_repos_to_licenses()
+    ok = check(cur, 'Scanned', dict([(repo_id, sorted(abbrs))
+                                     for repo_id, abbrs in REPOS.items()]))
+
+    # New rules that read MIT as ISC
+    license_id.rule_engine = rules.RuleEngine(aliases={'MIT': 'ISC'})
+    license_id.RULES_VERSION = rules.VERSION + 1
+
+    license_id.renormalize_stale()
+    license_id.process_licenses(stale_only=True)
+    license_id.map_repos_to_licenses()
+
+    ok = check(cur, 'Re-analyzed', dict([(repo_id, sorted(set(
+        ['ISC' if abbr == 'MIT' else abbr for abbr in abbrs])))
+        for repo_id, abbrs in REPOS.items()])) and ok
+
+    shutil.rmtree(export_path)
+    db_conn.close()
+
+    if not ok:
+        sys.exit(1)
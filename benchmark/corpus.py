@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Generates a synthetic corpus of repositories, license files and READMEs
+# for the benchmark stub server
+
+import json
+import random
+import hashlib
+import optparse
+
+# Each synthetic license carries a marker line the fake nomos reports
+LICENSES = ['MIT', 'Apache-2.0', 'GPL-2.0', 'GPL-3.0', 'BSD-3-Clause',
+            'LGPL-2.1', 'MPL-2.0', 'ISC', 'Artistic-2.0', 'Public-domain']
+LICENSE_FILENAMES = ['LICENSE', 'LICENSE.txt', 'LICENSE.md', 'COPYING',
+                     'COPYING.LESSER', 'MIT-LICENSE', 'LICENCE']
+README_FILENAMES = ['README.md', 'README', 'README.rst', 'README.txt']
+OTHER_FILENAMES = ['setup.py', 'Makefile', '.gitignore', 'main.c',
+                   'package.json', 'index.js', 'CHANGELOG']
+WORDS = ("software permission granted copy modify merge publish distribute "
+         "sublicense sell warranty liability contract tort notice conditions "
+         "source binary redistribution use provided following holders "
+         "contributors express implied merchantability fitness purpose "
+         "damages event authors").split()
+
+
+def marker(abbr):
+    return "License-Benchmark-Id: %s" % abbr
+
+
+def license_text(abbr, holder, year, rng):
+    # A fixed body per license (so copies are byte-identical apart from
+    # the copyright line) of a few hundred words
+    body_rng = random.Random(abbr)
+    paragraphs = []
+
+    for i in range(body_rng.randint(4, 12)):
+        paragraphs.append(" ".join([body_rng.choice(WORDS)
+                                    for j in range(body_rng.randint(30, 80))]))
+
+    return "%s\n\nCopyright (c) %s %s\n\n%s\n\n%s\n" % \
+        (abbr, year, holder, marker(abbr), "\n\n".join(paragraphs))
+
+
+def readme_text(abbr, name, rng, size):
+    lines = ["# %s" % name, ""]
+
+    while sum([len(line) for line in lines]) < size:
+        lines.append(" ".join([rng.choice(WORDS)
+                               for j in range(rng.randint(8, 20))]))
+
+    if abbr:
+        lines += ["", "## License", "", "Released under the %s license." % \
+                  abbr, marker(abbr)]
+
+    return "\n".join(lines) + "\n"
+
+
+def git_sha(content):
+    # The blob SHA git (and the contents API) would report
+    return hashlib.sha1("blob %d\0%s" % (len(content), content)).hexdigest()
+
+
+def generate(repos=1000, seed=0, holders=50, fork_ratio=0.1,
+             no_license_ratio=0.3, readme_size=2000, bom_ratio=0.05):
+    # Returns a list of repos, each with the files in its root directory.
+    # bom_ratio of the license files start with a UTF-8 byte order mark
+    # (decided apart from the seeded draws, so the rest of the corpus
+    # doesn't change with it).
+    rng = random.Random(seed)
+    corpus = []
+
+    for i in range(repos):
+        owner = "owner%s" % rng.randint(0, max(repos / 10, 1))
+        name = "repo%s" % i
+        files = {}
+
+        for filename in rng.sample(OTHER_FILENAMES, rng.randint(1, 4)):
+            files[filename] = "placeholder %s\n" % filename
+
+        abbr = None
+
+        if rng.random() > no_license_ratio:
+            abbr = rng.choice(LICENSES)
+            holder = "holder%s" % rng.randint(0, holders)
+            year = rng.randint(2000, 2014)
+
+            for filename in rng.sample(LICENSE_FILENAMES, rng.randint(1, 2)):
+                files[filename] = license_text(abbr, holder, year, rng)
+
+                if random.Random("%s/%s" % (name, filename)).random() < \
+                        bom_ratio:
+                    files[filename] = "\xef\xbb\xbf" + files[filename]
+
+        if rng.random() < 0.9:
+            readme = rng.choice(README_FILENAMES)
+            files[readme] = readme_text(abbr, name, rng,
+                                        rng.randint(readme_size / 4,
+                                                    readme_size * 2))
+
+        corpus.append({'id': i + 1,
+                       'owner': owner,
+                       'name': name,
+                       'fork': rng.random() < fork_ratio,
+                       'license': abbr,
+                       'files': files})
+
+    return corpus
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('-n', '--repos',
+                      action="store", dest="repos", type="int",
+                      help="""Number of repositories to generate""",
+                      default=1000)
+
+    parser.add_option('-s', '--seed',
+                      action="store", dest="seed", type="int",
+                      help="""Random seed""",
+                      default=0)
+
+    parser.add_option('-o', '--output',
+                      action="store", dest="output",
+                      help="""File to write the corpus to (JSON)""",
+                      default="corpus.json")
+
+    options, args = parser.parse_args()
+
+    f = open(options.output, 'w')
+    f.write(json.dumps(generate(options.repos, options.seed)))
+    f.close()
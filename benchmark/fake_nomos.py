@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Stand-in for FOSSology nomos: reports the License-Benchmark-Id markers
+# in the synthetic corpus files, in nomos' output format. Set
+# FAKE_NOMOS_DELAY (seconds) to simulate per-file scan time.
+
+import os
+import re
+import sys
+import time
+
+marker_re = re.compile(r"License-Benchmark-Id: (\S+)")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['-V']:
+        print('fake_nomos build version: 1')
+        sys.exit(0)
+
+    delay = float(os.environ.get('FAKE_NOMOS_DELAY') or 0)
+
+    for path in sys.argv[1:]:
+        f = open(path, 'r')
+        licenses = marker_re.findall(f.read())
+        f.close()
+
+        if delay:
+            time.sleep(delay)
+
+        # nomos reports each license once
+        seen = []
+        for abbr in licenses:
+            if not abbr in seen:
+                seen.append(abbr)
+
+        sys.stdout.write("File %s contains license(s) %s\n" % \
+            (os.path.basename(path), ",".join(seen) or "No_license_found"))
+        sys.stdout.flush()
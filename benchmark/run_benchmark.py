@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# Measures crawler and analyzer throughput against the local stub API,
+# a synthetic corpus and a fake nomos, without spending real quota.
+#
+#   python benchmark/run_benchmark.py -n 2000 --latency 0.05 -c 8 -w 4
+#
+# Use --save to keep the results and --compare to fail (exit 1) when a
+# later run is slower than the saved one by more than --tolerance.
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import optparse
+import tempfile
+import itertools
+import multiprocessing
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_path, '..'))
+
+import corpus
+import stub_server
+import credentials
+import db_writer
+import ghretrieve
+import license_id
+import readme
+
+logger = logging.getLogger(__name__)
+
+# Higher is better for these; requests_per_repo is better lower
+RATES = ['repos_per_sec', 'db_rows_per_sec', 'files_per_sec',
+         'nomos_calls_per_sec']
+
+
+def bench_crawl(server, concurrency=1, discovery='contents', db_conn=None,
+                prefetch=2):
+    # Crawl the whole stub corpus with ghretrieve's own request, fetch and
+    # (with a database) storage code
+    ghretrieve.config = {}
+    ghretrieve.logger = logger
+    ghretrieve.api_url = server.base_url
+    ghretrieve.discovery = discovery
+    ghretrieve.known_shas = set()
+    ghretrieve.scheduler = credentials.CredentialScheduler(
+        credentials.load_credentials({}))
+    ghretrieve.init_session(max(10, concurrency))
+
+    writer = None
+
+    if db_conn:
+        writer = db_writer.PageWriter(db_conn)
+
+    url = "%s/repositories" % server.base_url
+    start_requests = server.total_requests()
+    repos = 0
+    db_rows = 0
+    db_time = 0.0
+    start = time.time()
+
+    for page, next_url, done in ghretrieve.prefetch(
+            ghretrieve.list_pages(url), prefetch):
+        if writer:
+            t = time.time()
+            new_repos = writer.store_repos(page)
+            db_time += time.time() - t
+
+            ghretrieve.store_licenses(writer, new_repos, concurrency)
+            db_rows += len(page) + len(writer.license_rows)
+
+            t = time.time()
+            writer.flush()
+            ghretrieve.remember_shas(writer)
+            db_time += time.time() - t
+        else:
+            ghretrieve.get_licenses_for_repos(page, concurrency)
+
+        repos += len(page)
+
+    elapsed = time.time() - start
+    requests = server.total_requests() - start_requests
+
+    results = {'repos': repos,
+               'crawl_seconds': elapsed,
+               'repos_per_sec': repos / elapsed,
+               'requests_per_repo': float(requests) / max(repos, 1)}
+
+    if writer:
+        results['db_rows'] = db_rows
+        results['db_rows_per_sec'] = db_rows / max(db_time, 1e-6)
+
+    return results
+
+
+def bench_analysis(repos, workers=1, batch_size=50, nomos_delay=0.0):
+    # Scan each distinct license file / README blob in the corpus with
+    # license_id's batching and worker pool and the fake nomos
+    jobs = []
+    seen = set()
+    bytes_scanned = 0
+    total_bytes = 0
+
+    for repo in repos:
+        for name in sorted(repo['files']):
+            if not (ghretrieve.license_pattern.search(name) or
+                    ghretrieve.readme_pattern.match(name)):
+                continue
+
+            content = repo['files'][name]
+            sha = corpus.git_sha(content)
+
+            if sha in seen:
+                continue
+
+            seen.add(sha)
+            scan_text = readme.scan_text(name, content)
+            bytes_scanned += len(scan_text)
+            total_bytes += len(content)
+
+            jobs.append((('sha', sha), name, scan_text))
+
+    base_path = tempfile.mkdtemp(prefix='license_bench')
+
+    license_id.config = {'nomos_path': os.path.join(bench_path,
+                                                    'fake_nomos.py'),
+                         'nomos_timeout': 300}
+    license_id.logger = logger
+    license_id.engine = 'nomos'
+    os.environ['FAKE_NOMOS_DELAY'] = str(nomos_delay)
+
+    batches = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+    pool = None
+    start = time.time()
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, license_id.init_scan_worker,
+                                    (base_path,))
+        scans = pool.imap(license_id.scan_licenses, batches)
+    else:
+        license_id.init_scan_worker(base_path)
+        scans = itertools.imap(license_id.scan_licenses, batches)
+
+    scanned = sum([len(batch) for batch in scans])
+    elapsed = time.time() - start
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    shutil.rmtree(base_path)
+
+    return {'files': scanned,
+            'analysis_seconds': elapsed,
+            'files_per_sec': scanned / elapsed,
+            'nomos_calls_per_sec': len(batches) / elapsed,
+            'bytes_skipped_pct': 100.0 * (total_bytes - bytes_scanned) / \
+                max(total_bytes, 1)}
+
+
+def compare(results, baseline, tolerance):
+    # Returns the metrics that got worse by more than tolerance
+    regressions = []
+
+    for name in RATES + ['requests_per_repo']:
+        if not name in results or not name in baseline:
+            continue
+
+        change = (results[name] - baseline[name]) / max(baseline[name], 1e-9)
+
+        if name == 'requests_per_repo':
+            change = -change
+
+        print('%-20s %10.2f (baseline %.2f, %+.1f%%)' % \
+                  (name, results[name], baseline[name], change * 100))
+
+        if change < -tolerance:
+            regressions.append(name)
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('-n', '--repos',
+                      action="store", dest="repos", type="int",
+                      help="""Number of synthetic repositories""",
+                      default=1000)
+
+    parser.add_option('--corpus',
+                      action="store", dest="corpus",
+                      help="""Load the corpus from a file written by
+                              corpus.py instead of generating one""",
+                      default="")
+
+    parser.add_option('--latency',
+                      action="store", dest="latency", type="float",
+                      help="""Seconds of latency the stub adds to every
+                              request""",
+                      default=0.0)
+
+    parser.add_option('-c', '--concurrency',
+                      action="store", dest="concurrency", type="int",
+                      help="""Crawler concurrency""",
+                      default=1)
+
+    parser.add_option('--prefetch',
+                      action="store", dest="prefetch", type="int",
+                      help="""Pages the crawler lists ahead""",
+                      default=2)
+
+    parser.add_option('-d', '--discovery',
+                      action="store", dest="discovery",
+                      help="""Crawler discovery mode: 'contents' or
+                              'graphql'""",
+                      default='contents')
+
+    parser.add_option('-w', '--workers',
+                      action="store", dest="workers", type="int",
+                      help="""Analyzer worker processes""",
+                      default=1)
+
+    parser.add_option('-b', '--batch_size',
+                      action="store", dest="batch_size", type="int",
+                      help="""Files per nomos invocation""",
+                      default=50)
+
+    parser.add_option('--nomos_delay',
+                      action="store", dest="nomos_delay", type="float",
+                      help="""Seconds the fake nomos spends on each file""",
+                      default=0.0)
+
+    parser.add_option('--database',
+                      action="store", dest="database",
+                      help="""psycopg2 DSN of a scratch database created
+                              with db_setup.py; its tables are TRUNCATED.
+                              Without it DB writes aren't measured.""",
+                      default="")
+
+    parser.add_option('--save',
+                      action="store", dest="save",
+                      help="""Write the results to this JSON file""",
+                      default="")
+
+    parser.add_option('--compare',
+                      action="store", dest="compare",
+                      help="""Compare with results saved by --save""",
+                      default="")
+
+    parser.add_option('--tolerance',
+                      action="store", dest="tolerance", type="float",
+                      help="""Allowed slowdown before --compare fails""",
+                      default=0.1)
+
+    options, args = parser.parse_args()
+
+    logging.basicConfig(filename='benchmark.log', level=logging.ERROR)
+
+    if options.corpus:
+        f = open(options.corpus, 'r')
+        repos = json.loads(f.read())
+        f.close()
+    else:
+        repos = corpus.generate(options.repos)
+
+    db_conn = None
+
+    if options.database:
+        import psycopg2
+
+        db_conn = psycopg2.connect(options.database)
+        cur = db_conn.cursor()
+        cur.execute("""TRUNCATE repositories, license_blobs, repository_counts
+                          CASCADE""")
+        db_conn.commit()
+
+    server = stub_server.StubServer(repos, latency=options.latency)
+    server.start()
+
+    results = {}
+    results.update(bench_crawl(server, options.concurrency,
+                               options.discovery, db_conn, options.prefetch))
+    results.update(bench_analysis(repos, options.workers,
+                                  options.batch_size, options.nomos_delay))
+
+    server.shutdown()
+
+    for name in sorted(results):
+        print('%-20s %10.2f' % (name, results[name]))
+
+    if options.save:
+        f = open(options.save, 'w')
+        f.write(json.dumps(results, indent=1, sort_keys=True))
+        f.close()
+
+    if options.compare:
+        f = open(options.compare, 'r')
+        baseline = json.loads(f.read())
+        f.close()
+
+        regressions = compare(results, baseline, options.tolerance)
+
+        if regressions:
+            print('Regressed: %s' % ", ".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+# Local stand-in for the parts of the GitHub API the crawler uses:
+# /repositories (with Link headers), /repos/<owner>/<name>/contents/,
+# /repos/<owner>/<name>/readme, /rate_limit and the repository queries
+# ghretrieve sends to /graphql, with X-RateLimit-* headers, ETags and
+# configurable latency
+
+import json
+import time
+import re
+import threading
+import hashlib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from base64 import b64encode
+from corpus import git_sha
+
+repo_path_re = re.compile(r"^/repos/([^/]+)/([^/]+)/(contents/(.*)|readme)$")
+readme_re = re.compile(r"readme(\.|$)", re.IGNORECASE)
+graphql_repo_re = re.compile(r'(\w+): repository\(owner: ("[^"]*"), '
+                             r'name: ("[^"]*")\)')
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves a corpus from corpus.generate(). `latency` is added to every
+    response (seconds); `rate_limit` requests are allowed per `window`
+    seconds. Counts of requests by endpoint are kept in `stats`. GraphQL
+    blob text longer than `truncate` bytes is cut off and flagged
+    isTruncated, as GitHub does for large files, and is decoded as UTF-8
+    without any byte order mark, so it doesn't always hash to the blob's
+    SHA.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, corpus, port=0, latency=0.0, per_page=100,
+                 rate_limit=1000000, window=3600, truncate=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           StubHandler)
+        self.corpus = corpus
+        self.by_name = dict([("%s/%s" % (r['owner'], r['name']), r)
+                             for r in corpus])
+        self.latency = latency
+        self.per_page = per_page
+        self.rate_limit = rate_limit
+        self.window = window
+        self.truncate = truncate
+        self.reset = int(time.time()) + window
+        self.remaining = rate_limit
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%s" % self.server_address[1]
+
+    def count(self, endpoint, charged=True):
+        # Returns the remaining budget after this request and whether the
+        # request was within the limit
+        with self.lock:
+            self.stats[endpoint] = self.stats.get(endpoint, 0) + 1
+
+            if time.time() >= self.reset:
+                self.reset = int(time.time()) + self.window
+                self.remaining = self.rate_limit
+
+            allowed = self.remaining > 0
+
+            if charged and allowed:
+                self.remaining -= 1
+
+            return self.remaining, allowed
+
+    def total_requests(self):
+        # Everything but the (free) rate_limit checks
+        with self.lock:
+            return sum([self.stats[endpoint] for endpoint in self.stats
+                        if endpoint != 'rate_limit'])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return thread
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if url.path == '/rate_limit':
+            server.count('rate_limit', charged=False)
+            return self.send_rate_limit()
+
+        if url.path == '/repositories':
+            return self.send_repositories(urlparse.parse_qs(url.query))
+
+        m = repo_path_re.match(url.path)
+
+        if m and "%s/%s" % (m.group(1), m.group(2)) in server.by_name:
+            repo = server.by_name["%s/%s" % (m.group(1), m.group(2))]
+
+            if m.group(3) == 'readme':
+                return self.send_readme(repo)
+            if m.group(4):
+                return self.send_file(repo, m.group(4))
+
+            return self.send_contents(repo)
+
+        server.count('not_found')
+        self.send_json(404, {'message': 'Not Found'})
+
+    def do_POST(self):
+        server = self.server
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if urlparse.urlparse(self.path).path != '/graphql':
+            server.count('not_found')
+            return self.send_json(404, {'message': 'Not Found'})
+
+        length = int(self.headers.get('Content-Length') or 0)
+        query = json.loads(self.rfile.read(length))['query']
+        data = {}
+
+        for alias, owner, name in graphql_repo_re.findall(query):
+            repo = server.by_name.get("%s/%s" % (json.loads(owner),
+                                                 json.loads(name)))
+            data[alias] = repo and self.graphql_repo(repo)
+
+        self.send_json(200, {'data': data}, endpoint='graphql')
+
+    def graphql_repo(self, repo):
+        entries = []
+
+        for name in sorted(repo['files']):
+            content = repo['files'][name]
+            text = content
+            truncated = False
+
+            if self.server.truncate is not None and \
+                    len(content) > self.server.truncate:
+                text = content[:self.server.truncate]
+                truncated = True
+
+            text = text.decode('utf-8', 'replace').lstrip(u'\ufeff')
+
+            entries.append({'name': name,
+                            'type': 'blob',
+                            'oid': git_sha(content),
+                            'object': {'byteSize': len(content),
+                                       'isBinary': False,
+                                       'isTruncated': truncated,
+                                       'text': text}})
+
+        return {'url': "https://github.com/%s/%s" % (repo['owner'],
+                                                     repo['name']),
+                'defaultBranchRef': {'name': 'master'},
+                'object': {'entries': entries}}
+
+    def send_json(self, status, body, headers=None, endpoint=None):
+        server = self.server
+        content = json.dumps(body)
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+
+        # Conditional requests that match aren't charged, as on GitHub
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            remaining, allowed = server.count(endpoint or 'other',
+                                              charged=False)
+            status = 304
+            content = ""
+        elif endpoint:
+            remaining, allowed = server.count(endpoint)
+
+            if not allowed:
+                status = 403
+                content = json.dumps({'message': 'API rate limit exceeded'})
+        else:
+            remaining = server.remaining
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.send_header('X-RateLimit-Limit', str(server.rate_limit))
+        self.send_header('X-RateLimit-Remaining', str(remaining))
+        self.send_header('X-RateLimit-Reset', str(server.reset))
+        self.send_header('X-RateLimit-Resource', 'core')
+        self.send_header('status', "%s" % status)
+
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_rate_limit(self):
+        server = self.server
+        limit = {'limit': server.rate_limit, 'remaining': server.remaining,
+                 'reset': server.reset}
+        self.send_json(200, {'resources': {'core': limit, 'graphql': limit},
+                             'rate': limit})
+
+    def send_repositories(self, query):
+        server = self.server
+        since = int(query.get('since', ['0'])[0])
+        page = [repo for repo in server.corpus
+                if repo['id'] > since][:server.per_page]
+        headers = {}
+
+        if page and page[-1]['id'] < server.corpus[-1]['id']:
+            headers['Link'] = '<%s/repositories?since=%s>; rel="next", '\
+                              '<%s/repositories{?since}>; rel="first"' % \
+                              (server.base_url, page[-1]['id'],
+                               server.base_url)
+        else:
+            headers['Link'] = '<%s/repositories{?since}>; rel="first"' % \
+                              server.base_url
+
+        self.send_json(200, [self.repo_item(repo) for repo in page],
+                       headers, 'repositories')
+
+    def repo_item(self, repo):
+        base_url = self.server.base_url
+        full_name = "%s/%s" % (repo['owner'], repo['name'])
+
+        return {'id': repo['id'],
+                'name': repo['name'],
+                'full_name': full_name,
+                'owner': {'login': repo['owner']},
+                'private': False,
+                'fork': repo['fork'],
+                'description': "Synthetic repository %s" % repo['id'],
+                'url': "%s/repos/%s" % (base_url, full_name),
+                'html_url': "https://github.com/%s" % full_name}
+
+    def file_item(self, repo, name, with_content=False):
+        content = repo['files'][name]
+        api = "%s/repos/%s/%s/contents/%s" % \
+            (self.server.base_url, repo['owner'], repo['name'], name)
+        html = "https://github.com/%s/%s/blob/master/%s" % \
+            (repo['owner'], repo['name'], name)
+        item = {'type': 'file',
+                'name': name,
+                'path': name,
+                'size': len(content),
+                'sha': git_sha(content),
+                'url': api,
+                'html_url': html,
+                '_links': {'self': api, 'html': html}}
+
+        if with_content:
+            item['encoding'] = 'base64'
+            item['content'] = b64encode(content)
+
+        return item
+
+    def send_contents(self, repo):
+        self.send_json(200, [self.file_item(repo, name)
+                             for name in sorted(repo['files'])],
+                       endpoint='contents')
+
+    def send_file(self, repo, name):
+        if not name in repo['files']:
+            self.server.count('file')
+            return self.send_json(404, {'message': 'Not Found'})
+
+        self.send_json(200, self.file_item(repo, name, True),
+                       endpoint='file')
+
+    def send_readme(self, repo):
+        for name in sorted(repo['files']):
+            if readme_re.match(name):
+                return self.send_json(200, self.file_item(repo, name, True),
+                                      endpoint='readme')
+
+        self.server.count('readme')
+        self.send_json(404, {'message': 'Not Found'})
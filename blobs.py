@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# License file bodies are stored once per git SHA in license_blobs,
+# decoded and zlib-compressed, instead of as base64 TEXT on every
+# repository_licenses row.
+#
+# Run as a script to move the content of an existing database (after
+# db_setup.py has added the license_blobs table):
+#
+#   python blobs.py [--static]
+
+import zlib
+import hashlib
+import logging
+import optparse
+import sys
+import yaml
+import psycopg2
+import psycopg2.extras
+from base64 import b64decode
+
+logger = logging.getLogger(__name__)
+
+
+def git_sha(data):
+    # The blob SHA git (and the contents API) would report
+    return hashlib.sha1("blob %d\0%s" % (len(data), data)).hexdigest()
+
+
+def compress(data):
+    return psycopg2.Binary(zlib.compress(data))
+
+
+def decompress(content):
+    # content is a bytea value as psycopg2 returns it
+    return zlib.decompress(str(content))
+
+
+def file_text(blob_content, legacy_content=None):
+    # The raw bytes of a license file, from its blob or, for rows that
+    # haven't been migrated yet, the base64 repository_licenses.content
+    if blob_content is not None:
+        return decompress(blob_content)
+
+    if legacy_content is not None:
+        return b64decode(legacy_content)
+
+    return None
+
+
+def blob_rows(license_rows):
+    # (sha, size, compressed content) for each distinct blob among
+    # db_writer.license_row tuples that carry base64 content and a sha
+    rows = {}
+
+    for row in license_rows:
+        if row[8] is None or row[9] is None or row[9] in rows:
+            continue
+
+        data = b64decode(row[8])
+        rows[row[9]] = (len(data), compress(data))
+
+    return [(sha, size, content) for sha, (size, content) in rows.items()]
+
+
+def migrate(db_conn, batch_size=1000):
+    # Move repository_licenses.content into license_blobs, one committed
+    # batch at a time, so an interrupted migration can simply be rerun
+    cur = db_conn.cursor()
+    last_id = -1
+    moved = 0
+
+    while True:
+        cur.execute("""SELECT id, sha, content FROM repository_licenses
+                        WHERE content IS NOT NULL
+                          AND id > %s
+                     ORDER BY id
+                        LIMIT %s""", (last_id, batch_size))
+        rows = cur.fetchall()
+
+        if not rows:
+            break
+
+        last_id = rows[-1][0]
+        blobs = {}
+        updates = []
+
+        for license_id, sha, content in rows:
+            data = b64decode(content)
+            sha = sha or git_sha(data)
+
+            if not sha in blobs:
+                blobs[sha] = (sha, len(data), compress(data))
+
+            updates.append((license_id, sha))
+
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO license_blobs(sha, size, content) VALUES %s
+            ON CONFLICT (sha) DO NOTHING
+            """, blobs.values())
+
+        psycopg2.extras.execute_values(cur, """
+            UPDATE repository_licenses l
+               SET content = NULL, sha = v.sha
+              FROM (VALUES %s) AS v(id, sha)
+             WHERE l.id = v.id
+            """, updates)
+
+        db_conn.commit()
+
+        moved = moved + len(rows)
+        logger.info("Moved the content of %s license files into "\
+                    "license_blobs" % moved)
+
+    return moved
+
+
+if __name__ == "__main__":
+    config_file = open('config.yaml', 'r')
+    config = yaml.load(config_file.read())
+
+    parser = optparse.OptionParser()
+
+    parser.add_option('--static',
+                      action="store_true", dest="static",
+                      help="""Migrate the static_database license_id.py
+                              reads instead of the crawler's database""",
+                      default=False)
+
+    parser.add_option('-b', '--batch_size',
+                      action="store", dest="batch_size", type="int",
+                      help="""License files to move per transaction""",
+                      default=1000)
+
+    options, args = parser.parse_args()
+
+    logging.basicConfig(filename='blobs.log', level=logging.ERROR)
+    logger.setLevel(logging.DEBUG)
+
+    prefix = 'static_database' if options.static else 'database'
+
+    db_conn = psycopg2.connect(database=config[prefix],
+                               user=config['%s_user' % prefix],
+                               password=config['%s_password' % prefix])
+
+    try:
+        moved = migrate(db_conn, options.batch_size)
+    except psycopg2.DatabaseError, e:
+        db_conn.rollback()
+        print 'Error %s' % e
+        sys.exit(1)
+    finally:
+        db_conn.close()
+
+    print 'Moved %s license files into license_blobs. Run VACUUM FULL '\
+          'repository_licenses to give the space back.' % moved
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Exact matching of license files against canonical license texts after
+# normalizing away whitespace, case and copyright lines
+
+import os
+import re
+import json
+import hashlib
+from collections import OrderedDict
+
+copyright_re = re.compile(ur"^\s*(copyright|\(c\)|©)", re.IGNORECASE)
+whitespace_re = re.compile(r"\s+", re.UNICODE)
+
+
+def normalize_text(text):
+    # Drop copyright/holder lines, fold case and collapse whitespace, so
+    # a verbatim license with a different year, holder or line wrapping
+    # normalizes to the same string
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+
+    lines = [line for line in text.splitlines()
+             if not copyright_re.match(line)]
+
+    return whitespace_re.sub(u" ", u" ".join(lines)).strip().lower()
+
+
+def text_hash(text):
+    return hashlib.sha1(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class LearnedHashes(object):
+    """
+    Normalized text hash -> abbreviations a scanner found, for the `size`
+    texts most recently looked up or added, so later copies of a text can
+    skip the scanner without the table growing for the whole run.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, text_hash):
+        if not text_hash in self.entries:
+            return None
+
+        licenses = self.entries.pop(text_hash)
+        self.entries[text_hash] = licenses
+
+        return licenses
+
+    def add(self, text_hash, licenses):
+        self.entries.pop(text_hash, None)
+        self.entries[text_hash] = licenses
+
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def load_table(path):
+    # Normalized text hash -> list of license abbreviations
+    if not path or not os.path.exists(path):
+        return {}
+
+    f = open(path, 'r')
+    table = json.loads(f.read())
+    f.close()
+
+    return table
+
+
+def table_version(table):
+    # Changes whenever the table does, for stamping the results it gives
+    return hashlib.sha1(json.dumps(table, sort_keys=True)).hexdigest()[:12]
+
+
+def build_table(reference_path, path):
+    # Hash every reference text (named after its abbreviation, as for
+    # the fingerprint classifier) and write the table out as JSON
+    table = load_table(path)
+
+    for filename in sorted(os.listdir(reference_path)):
+        f = open(os.path.join(reference_path, filename), 'r')
+        text = f.read()
+        f.close()
+
+        table[text_hash(text)] = [os.path.splitext(filename)[0]]
+
+    f = open(path, 'w')
+    f.write(json.dumps(table, indent=1, sort_keys=True))
+    f.close()
+
+    return table
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Spreads GitHub API requests over several credentials, tracking the rate
+# limit of each one separately
+
+import threading
+import time
+
+
+def load_credentials(config):
+    # Build the credential list from config.yaml: any 'github_tokens' plus
+    # the old github_user/github_password pair. With neither, requests go
+    # out unauthenticated.
+    credentials = []
+
+    for token in config.get('github_tokens') or []:
+        credentials.append({'name': "token %s..." % token[:4],
+                            'auth': None,
+                            'headers': {'Authorization': "token %s" % token}})
+
+    u = config.get('github_user')
+    p = config.get('github_password')
+
+    if u and p:
+        credentials.append({'name': u, 'auth': (u, p), 'headers': {}})
+
+    if not credentials:
+        credentials.append({'name': 'anonymous', 'auth': None, 'headers': {}})
+
+    return credentials
+
+
+class CredentialScheduler(object):
+    """
+    Tracks X-RateLimit-Remaining and X-RateLimit-Reset for each credential
+    and rate limit resource ('core', 'graphql', ...) and hands out the
+    credential with the most requests left. When every credential is
+    down to its reserve, acquire() returns None and reset_wait() says how
+    long until the earliest one resets.
+    """
+
+    def __init__(self, credentials, reserve=10):
+        self.lock = threading.Lock()
+        self.reserve = reserve
+        self.credentials = credentials
+
+        for credential in self.credentials:
+            credential['limits'] = {}
+
+    def limit(self, credential, resource):
+        # Until we've heard from GitHub, assume a credential is usable
+        return credential['limits'].setdefault(resource,
+                                               {'remaining': None,
+                                                'reset': 0})
+
+    def acquire(self, resource='core'):
+        with self.lock:
+            best = None
+            best_limit = None
+
+            for credential in self.credentials:
+                limit = self.limit(credential, resource)
+                remaining = limit['remaining']
+
+                if remaining is None:
+                    best = credential
+                    best_limit = limit
+                    break
+
+                if remaining >= self.reserve and \
+                        (best is None or remaining > best_limit['remaining']):
+                    best = credential
+                    best_limit = limit
+
+            # Count the request against the credential now so concurrent
+            # workers don't all pick the same one
+            if best is not None and best_limit['remaining'] is not None:
+                best_limit['remaining'] -= 1
+
+            return best
+
+    def update(self, credential, r):
+        remaining = r.headers.get('X-RateLimit-Remaining')
+        reset = r.headers.get('X-RateLimit-Reset')
+        resource = r.headers.get('X-RateLimit-Resource', 'core')
+
+        if remaining is None or reset is None:
+            return
+
+        self.set_limit(credential, resource, int(remaining), int(reset))
+
+    def set_limit(self, credential, resource, remaining, reset):
+        with self.lock:
+            limit = self.limit(credential, resource)
+
+            # Responses can arrive out of order; within one window the
+            # lowest count we've seen is the most recent
+            if reset == limit['reset'] and limit['remaining'] is not None:
+                remaining = min(remaining, limit['remaining'])
+
+            limit['remaining'] = remaining
+            limit['reset'] = reset
+
+    def remaining(self, resource='core'):
+        with self.lock:
+            return sum([self.limit(c, resource)['remaining'] or 0
+                        for c in self.credentials])
+
+    def exhausted(self, resource='core'):
+        with self.lock:
+            for credential in self.credentials:
+                remaining = self.limit(credential, resource)['remaining']
+
+                if remaining is None or remaining >= self.reserve:
+                    return False
+
+            return True
+
+    def reset_wait(self, resource='core'):
+        # Seconds until the earliest exhausted credential resets
+        with self.lock:
+            earliest = min([self.limit(c, resource)['reset']
+                            for c in self.credentials])
+
+        wait = earliest - int(time.time()) + 1
+
+        # Still exhausted past the reset time means GitHub hasn't caught
+        # up (or rate_limit failed); check back in a minute
+        if wait <= 0:
+            wait = 60
+
+        return wait
@@ -1,11 +1,14 @@
-# Creates a simple postgres DB to store the GH data in
+# Creates a simple postgres DB to store the GH data in, or brings an
+# existing one up to date with the migrations in schema.py
 #
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
 import psycopg2
+import optparse
 import sys
 import yaml
+import schema
 
 con = None
 
@@ -13,64 +16,51 @@ con = None
 config_file = open('config.yaml', 'r')
 config = yaml.load(config_file.read())
 
+parser = optparse.OptionParser()
+
+parser.add_option('--static',
+                  action="store_true", dest="static",
+                  help="""Set up the static_database license_id.py reads
+                          instead of the crawler's database""",
+                  default=False)
+
+parser.add_option('--rebuild_aggregates',
+                  action="store_true", dest="rebuild_aggregates",
+                  help="""Recompute the repository and license count
+                          tables from scratch""",
+                  default=False)
+
+options, args = parser.parse_args()
+
+prefix = 'static_database' if options.static else 'database'
+
 try:
-     
-    con = psycopg2.connect(database=config['database'], 
-                           user=config['database_user'],
-                           password=config['database_password'])    
-    
-    cur = con.cursor()
-  
-    cur.execute("""CREATE TABLE repositories(id SERIAL PRIMARY KEY, 
-                                gh_id INT UNIQUE,
-                                owner_login VARCHAR,
-                                name VARCHAR,
-                                full_name VARCHAR,
-                                description VARCHAR,
-                                private BOOLEAN,
-                                fork BOOLEAN,
-                                api_url VARCHAR,
-                                html_url VARCHAR)""")
-
-    cur.execute("""CREATE TABLE repository_licenses(id SERIAL PRIMARY KEY, 
-                                repository_id INT REFERENCES 
-                                                  repositories (gh_id),
-                                type VARCHAR,
-                                encoding VARCHAR,
-                                api_url VARCHAR,
-                                html_url VARCHAR,
-                                size INT,
-                                name VARCHAR,
-                                path VARCHAR,
-                                content TEXT,
-                                sha VARCHAR)""")
-
-    cur.execute("""CREATE TABLE license_metadata(id SERIAL PRIMARY KEY, 
-                                license_id INT REFERENCES 
-                                               repository_licenses (id),
-                                is_primary BOOLEAN DEFAULT FALSE,
-                                license_abbr VARCHAR,
-                                UNIQUE(license_id, license_abbr))""")
-
-    cur.execute("""CREATE TABLE repository_license_abbr(repository_id INT REFERENCES 
-                                               repositories(id),
-                                license_abbr_id INT REFERENCES
-					licenses(id),
-                                UNIQUE(repository_id, license_abbr_id))""")
-
-    con.commit()
-    
+
+    con = psycopg2.connect(database=config[prefix],
+                           user=config['%s_user' % prefix],
+                           password=config['%s_password' % prefix])
+
+    applied = schema.migrate(con)
+
+    if applied:
+        print 'Applied migrations %s' % ", ".join([str(v) for v in applied])
+    else:
+        print 'Schema is up to date'
+
+    if options.rebuild_aggregates:
+        schema.rebuild_aggregates(con)
+
 
 except psycopg2.DatabaseError, e:
-    
+
     if con:
         con.rollback()
-    
-    print 'Error %s' % e    
+
+    print 'Error %s' % e
     sys.exit(1)
-    
-    
+
+
 finally:
-    
+
     if con:
         con.close()
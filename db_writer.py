@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+# Buffered writes of repositories and their license files, one transaction
+# per page of repos
+
+import psycopg2
+import psycopg2.extras
+import metrics
+import blobs
+import shards
+import schema
+
+# Give up on a repo's license files after this many failed fetches
+MAX_FETCH_ATTEMPTS = 5
+
+
+def repo_row(repo):
+    #Some repos don't have owners
+    try:
+        owner = repo['owner']['login']
+    except TypeError:
+        owner = ""
+
+    return (repo['id'], owner, repo['name'], repo['full_name'],
+            repo['description'], repo['private'], repo['fork'],
+            repo['url'], repo['html_url'])
+
+
+def license_row(repo_id, alicense):
+    return (repo_id, alicense['type'], alicense['encoding'],
+            alicense['_links']['self'], alicense['_links']['html'],
+            alicense['size'], alicense['name'], alicense['path'],
+            alicense['content'], alicense['sha'])
+
+
+def unmap_repos(cur, repo_ids):
+    # Drop the license mappings of the repos with these GitHub ids and
+    # take them off license_repo_counts, until license_id.py -a maps
+    # them again
+    cur.execute("""
+        WITH gone AS (
+        DELETE FROM repository_license_abbr a
+         USING repositories r
+         WHERE r.id = a.repository_id
+           AND r.gh_id = ANY(%s)
+     RETURNING a.license_abbr_id, r.fork)
+
+        UPDATE license_repo_counts c
+           SET repos = c.repos - g.repos,
+               fork_repos = c.fork_repos - g.fork_repos,
+               updated_at = now()
+          FROM (SELECT license_abbr_id, COUNT(*) AS repos,
+                       COUNT(*) FILTER (WHERE fork) AS fork_repos
+                  FROM gone
+              GROUP BY license_abbr_id) g
+         WHERE c.license_abbr_id = g.license_abbr_id
+        """, (list(repo_ids),))
+
+
+class PageWriter(object):
+    """
+    Collects a page's worth of repositories and license files and writes
+    them with multi-row inserts in a single transaction. Repos and files
+    (by repo and path) we've already stored are skipped with ON CONFLICT
+    DO NOTHING. File bodies go to license_blobs; repository_licenses rows
+    refer to them by sha.
+
+    For --refresh it also buffers files that changed or went away in
+    repos already stored. Their licenses are dropped, along with the
+    repos' license mappings, so license_id.py --reanalyze_stale rescans
+    changed files and -a maps the repos again. Deleted files keep their
+    scan row with a new change_id, so export.py --incremental sees them
+    go.
+    """
+
+    def __init__(self, db_conn, page_size=1000):
+        self.db_conn = db_conn
+        self.cur = db_conn.cursor()
+        self.page_size = page_size
+        self.license_rows = []
+        self.status_rows = []
+        self.changed_rows = []
+        self.deleted_rows = []
+        self.checked_ids = []
+        self.repo_counts = {}
+        self.cursor = None
+        self.shard = None
+        self.stored_shas = []
+
+    def store_repos(self, repos):
+        # Insert the page's repos and return the ones that are new. The
+        # transaction stays open until flush().
+        if not repos:
+            return []
+
+        rows = [repo_row(repo) for repo in repos]
+
+        with metrics.timer('db.insert_repos'):
+            new_ids = psycopg2.extras.execute_values(self.cur, """
+                    INSERT INTO repositories(gh_id, owner_login, name,
+                                full_name, description, private, fork,
+                                api_url, html_url) VALUES %s
+                    ON CONFLICT (gh_id) DO NOTHING
+                    RETURNING gh_id
+                    """, rows, page_size=self.page_size, fetch=True)
+
+        new_ids = set([row[0] for row in new_ids])
+        new_repos = [repo for repo in repos if repo['id'] in new_ids]
+
+        # Added to repository_counts at flush()
+        for repo in new_repos:
+            fork = bool(repo['fork'])
+            self.repo_counts[fork] = self.repo_counts.get(fork, 0) + 1
+
+        return new_repos
+
+    def add_license(self, repo_id, alicense):
+        self.license_rows.append(license_row(repo_id, alicense))
+
+    def replace_license(self, license_id, repo_id, alicense):
+        # A stored file whose content changed
+        self.changed_rows.append((license_id, license_row(repo_id, alicense)))
+
+    def mark_deleted(self, license_id, repo_id):
+        self.deleted_rows.append((license_id, repo_id))
+
+    def set_checked(self, repo_id):
+        # The repo's license files are up to date as of this page
+        self.checked_ids.append(repo_id)
+
+    def set_status(self, repo_id, status):
+        # Record whether a repo's license files were fetched ('done') or
+        # need another try ('failed')
+        self.status_rows.append((repo_id, status))
+
+    def set_cursor(self, name, next_url, last_id):
+        # Where to pick the crawl back up once this page is committed
+        self.cursor = (name, next_url, last_id)
+
+    def set_shard_progress(self, shard_id, worker, next_since, done=False):
+        # Like set_cursor, for a shard claimed from crawl_shards by worker
+        self.shard = ('done' if done else 'running', next_since, shard_id,
+                      worker)
+
+    def get_cursor(self, name):
+        self.cur.execute("""SELECT next_url, last_id FROM crawl_state
+                             WHERE name = %s""", (name,))
+        row = self.cur.fetchone()
+        self.db_conn.commit()
+
+        return row
+
+    def failed_repos(self):
+        # Repos whose license files still need fetching
+        self.cur.execute("""SELECT r.gh_id, r.full_name, r.api_url
+                             FROM crawl_repo_status s
+                             JOIN repositories r
+                               ON r.gh_id = s.repository_id
+                            WHERE s.status = 'failed'
+                              AND s.attempts < %s
+                         ORDER BY r.gh_id""", (MAX_FETCH_ATTEMPTS,))
+        rows = self.cur.fetchall()
+        self.db_conn.commit()
+
+        return [{'id': row[0], 'full_name': row[1], 'url': row[2]}
+                for row in rows]
+
+    def now(self):
+        self.cur.execute("""SELECT now()""")
+        now = self.cur.fetchone()[0]
+        self.db_conn.commit()
+
+        return now
+
+    def unchecked_repos(self, before, skip=(), limit=100):
+        # The repos least recently checked, if that was before `before`,
+        # other than those in skip
+        self.cur.execute("""SELECT gh_id, full_name, api_url
+                             FROM repositories
+                            WHERE (checked_at IS NULL OR checked_at < %s)
+                              AND NOT gh_id = ANY(%s::int[])
+                         ORDER BY checked_at NULLS FIRST, gh_id
+                            LIMIT %s""", (before, list(skip), limit))
+        rows = self.cur.fetchall()
+        self.db_conn.commit()
+
+        return [{'id': row[0], 'full_name': row[1], 'url': row[2]}
+                for row in rows]
+
+    def stored_licenses(self, repo_ids):
+        # repo id -> {path: (license id, sha, deleted)} for the files we
+        # have, including ones since deleted
+        self.cur.execute("""SELECT repository_id, path, id, sha,
+                                  deleted_at IS NOT NULL
+                             FROM repository_licenses
+                            WHERE repository_id = ANY(%s)""",
+                         (list(repo_ids),))
+        stored = {}
+
+        for repo_id, path, license_id, sha, deleted in self.cur.fetchall():
+            stored.setdefault(repo_id, {})[path] = (license_id, sha, deleted)
+
+        self.db_conn.commit()
+
+        return stored
+
+    def get_known_shas(self):
+        # SHAs of the license blobs we already have content for,
+        # including any not yet moved out of repository_licenses
+        self.cur.execute("""SELECT sha FROM license_blobs
+                             UNION
+                            SELECT sha FROM repository_licenses
+                             WHERE content IS NOT NULL""")
+        shas = set([row[0] for row in self.cur.fetchall()])
+        self.db_conn.commit()
+
+        return shas
+
+    def flush(self):
+        # Write out the buffered license files, fetch statuses and crawl
+        # cursor and commit the page. Afterwards stored_shas lists the
+        # blobs whose content went in with it.
+        self.stored_shas = []
+
+        try:
+            if self.license_rows:
+                blob_rows = blobs.blob_rows(self.license_rows)
+
+                with metrics.timer('db.insert_blobs'):
+                    psycopg2.extras.execute_values(self.cur, """
+                    INSERT INTO license_blobs(sha, size, content) VALUES %s
+                    ON CONFLICT (sha) DO NOTHING
+                    """, blob_rows, page_size=self.page_size)
+
+                # license_row puts content and sha last; files without
+                # a sha keep their content inline
+                rows = [row[:8] + (None if row[9] else row[8], row[9])
+                        for row in self.license_rows]
+
+                with metrics.timer('db.insert_licenses'):
+                    psycopg2.extras.execute_values(self.cur, """
+                    INSERT INTO repository_licenses(repository_id,
+                                type, encoding, api_url, html_url,
+                                size, name, path, content, sha) VALUES %s
+                    ON CONFLICT (repository_id, path) DO NOTHING
+                    """, rows, page_size=self.page_size)
+
+                metrics.count('db.license_rows', len(self.license_rows))
+
+            if self.changed_rows or self.deleted_rows:
+                self.write_refreshed()
+
+            if self.checked_ids:
+                self.cur.execute("""
+                    UPDATE repositories SET checked_at = now()
+                     WHERE gh_id = ANY(%s)
+                    """, (self.checked_ids,))
+
+            if self.status_rows:
+                psycopg2.extras.execute_values(self.cur, """
+                    INSERT INTO crawl_repo_status(repository_id, status)
+                         VALUES %s
+                    ON CONFLICT (repository_id) DO UPDATE
+                            SET status = EXCLUDED.status,
+                                attempts = crawl_repo_status.attempts + 1,
+                                updated_at = now()
+                    """, self.status_rows, page_size=self.page_size)
+
+            if self.repo_counts:
+                # Always in the same order, so concurrent crawlers can't
+                # deadlock on the two rows
+                psycopg2.extras.execute_values(self.cur, """
+                    INSERT INTO repository_counts(fork, repos) VALUES %s
+                    ON CONFLICT (fork) DO UPDATE
+                            SET repos = repository_counts.repos +
+                                        EXCLUDED.repos,
+                                updated_at = now()
+                    """, sorted(self.repo_counts.items()))
+
+            if self.cursor:
+                self.cur.execute("""
+                    INSERT INTO crawl_state(name, next_url, last_id)
+                         VALUES (%s, %s, %s)
+                    ON CONFLICT (name) DO UPDATE
+                            SET next_url = EXCLUDED.next_url,
+                                last_id = EXCLUDED.last_id,
+                                updated_at = now()
+                    """, self.cursor)
+
+            if self.shard:
+                self.cur.execute("""
+                    UPDATE crawl_shards
+                       SET status = %s, next_since = %s, updated_at = now()
+                     WHERE id = %s
+                       AND worker = %s
+                    """, self.shard)
+
+                # Don't overwrite the progress of whoever has it now
+                if self.cur.rowcount == 0:
+                    self.db_conn.rollback()
+                    raise shards.ShardLost("Shard #%s was claimed by "\
+                                           "another worker" % self.shard[2])
+
+            with metrics.timer('db.commit'):
+                self.db_conn.commit()
+
+            self.stored_shas = [row[9] for row in self.license_rows +
+                                [row for license_id, row in self.changed_rows]
+                                if row[8] is not None]
+        except psycopg2.DatabaseError:
+            self.db_conn.rollback()
+            raise
+        finally:
+            self.clear()
+
+    def write_refreshed(self):
+        # Swap in the new versions of changed files, mark deleted ones and
+        # queue both for analysis again
+        if self.changed_rows:
+            license_rows = [row for license_id, row in self.changed_rows]
+
+            psycopg2.extras.execute_values(self.cur, """
+                INSERT INTO license_blobs(sha, size, content) VALUES %s
+                ON CONFLICT (sha) DO NOTHING
+                """, blobs.blob_rows(license_rows), page_size=self.page_size)
+
+            with metrics.timer('db.update_licenses'):
+                psycopg2.extras.execute_values(self.cur, """
+                    UPDATE repository_licenses l
+                       SET type = v.type, encoding = v.encoding,
+                           api_url = v.api_url, html_url = v.html_url,
+                           size = v.size, content = NULL, sha = v.sha,
+                           deleted_at = NULL
+                      FROM (VALUES %s) AS v(id, type, encoding, api_url,
+                                            html_url, size, sha)
+                     WHERE l.id = v.id
+                    """, [(license_id,) + row[1:6] + (row[9],)
+                          for license_id, row in self.changed_rows],
+                    page_size=self.page_size)
+
+        if self.deleted_rows:
+            self.cur.execute("""
+                UPDATE repository_licenses SET deleted_at = now()
+                 WHERE id = ANY(%s)
+                """, ([license_id for license_id, repo_id in
+                       self.deleted_rows],))
+
+        license_ids = [license_id for license_id, row in self.changed_rows] + \
+            [license_id for license_id, repo_id in self.deleted_rows]
+        repo_ids = sorted(set([row[0] for license_id, row in
+                               self.changed_rows] +
+                              [repo_id for license_id, repo_id in
+                               self.deleted_rows]))
+
+        schema.lock_changes(self.cur)
+
+        self.cur.execute("""DELETE FROM license_metadata
+                             WHERE license_id = ANY(%s)""", (license_ids,))
+        self.cur.execute("""DELETE FROM license_scans
+                             WHERE license_id = ANY(%s)""",
+                         ([license_id for license_id, row in
+                           self.changed_rows],))
+        self.cur.execute("""
+            UPDATE license_scans
+               SET change_id = nextval('license_scan_changes')
+             WHERE license_id = ANY(%s)
+            """, ([license_id for license_id, repo_id in self.deleted_rows],))
+
+        unmap_repos(self.cur, repo_ids)
+
+        metrics.count('db.refreshed_licenses', len(license_ids))
+
+    def rollback(self):
+        self.clear()
+        self.db_conn.rollback()
+
+    def clear(self):
+        self.license_rows = []
+        self.status_rows = []
+        self.changed_rows = []
+        self.deleted_rows = []
+        self.checked_ids = []
+        self.repo_counts = {}
+        self.cursor = None
+        self.shard = None
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+# Streams the analysis results out of the static database into chunked
+# CSV files and/or Parquet or Arrow IPC files for visualization, reading
+# through a server-side cursor so memory use doesn't grow with the data
+#
+#   python export.py -o exports -f csv,parquet --fork no --incremental
+#
+# Parquet and Arrow output need pyarrow.
+
+import os
+import csv
+import sys
+import json
+import time
+import logging
+import optparse
+import yaml
+import psycopg2
+import metrics
+import schema
+
+logger = logging.getLogger(__name__)
+
+# name -> (columns with their types, key, query up to the WHERE clause).
+# The key is the first column: rows are exported in its order and
+# --incremental picks up after the last one exported. Filters apply to
+# the repositories table, aliased r.
+DATASETS = {
+    'repositories': ([('id', 'int'), ('gh_id', 'int'),
+                      ('owner_login', 'string'), ('name', 'string'),
+                      ('full_name', 'string'), ('description', 'string'),
+                      ('private', 'bool'), ('fork', 'bool'),
+                      ('html_url', 'string')], 'r.id',
+                     """SELECT r.id, r.gh_id, r.owner_login, r.name,
+                               r.full_name, r.description, r.private,
+                               r.fork, r.html_url
+                          FROM repositories r
+                         WHERE r.id > %(last_id)s"""),
+
+    'licenses': ([('id', 'int'), ('license_abbr', 'string'),
+                  ('name', 'string')], 'c.id',
+                 """SELECT c.id, c.license_abbr, c.name
+                      FROM licenses c
+                     WHERE c.id > %(last_id)s"""),
+
+    'license_files': ([('id', 'int'), ('repository_id', 'int'),
+                       ('name', 'string'), ('path', 'string'),
+                       ('size', 'int'), ('sha', 'string'),
+                       ('html_url', 'string')], 'l.id',
+                      """SELECT l.id, r.id, l.name, l.path, l.size, l.sha,
+                                l.html_url
+                           FROM repository_licenses l
+                           JOIN repositories r
+                             ON r.gh_id = l.repository_id
+                          WHERE l.id > %(last_id)s
+                            AND l.deleted_at IS NULL"""),
+
+    # Every license found in a file, or one row with no license_abbr if
+    # there are none. A file's rows are exported again, all together,
+    # whenever its results change; they replace the ones exported before.
+    # A file that was deleted gets a single row with deleted set.
+    'file_licenses': ([('change_id', 'int'), ('license_file_id', 'int'),
+                       ('repository_id', 'int'),
+                       ('license_abbr', 'string'), ('deleted', 'bool')],
+                      's.change_id',
+                      """SELECT s.change_id, s.license_id, r.id,
+                                m.license_abbr, l.deleted_at IS NOT NULL
+                           FROM license_scans s
+                           JOIN repository_licenses l
+                             ON l.id = s.license_id
+                           JOIN repositories r
+                             ON r.gh_id = l.repository_id
+                      LEFT JOIN license_metadata m
+                             ON m.license_id = s.license_id
+                          WHERE s.change_id > %(last_id)s
+                            AND s.change_id <= %(fence)s"""),
+
+    'repository_licenses': ([('id', 'int'), ('repository_id', 'int'),
+                             ('license_id', 'int'),
+                             ('license_abbr', 'string')], 'a.id',
+                            """SELECT a.id, a.repository_id,
+                                      a.license_abbr_id, c.license_abbr
+                                 FROM repository_license_abbr a
+                                 JOIN licenses c
+                                   ON c.id = a.license_abbr_id
+                                 JOIN repositories r
+                                   ON r.id = a.repository_id
+                                WHERE a.id > %(last_id)s"""),
+}
+
+# The master license list isn't tied to repositories
+UNFILTERED = ['licenses']
+
+# Keyed on change ids, which can commit out of order. Only ids up to
+# schema.committed_changes() are exported, and --incremental carries on
+# from there.
+FENCED = ['file_licenses']
+
+
+def export_query(name, fork=None, min_id=None, max_id=None):
+    columns, key, query = DATASETS[name]
+
+    if not name in UNFILTERED:
+        if fork is not None:
+            query = query + " AND r.fork = %(fork)s"
+        if min_id is not None:
+            query = query + " AND r.id >= %(min_id)s"
+        if max_id is not None:
+            query = query + " AND r.id <= %(max_id)s"
+
+    return query + " ORDER BY %s" % key
+
+
+class CSVWriter(object):
+    """
+    Writes rows to <prefix>-00000.csv, <prefix>-00001.csv, ... starting
+    a new file every `rows_per_file` rows, each with a header line.
+    """
+
+    def __init__(self, prefix, columns, rows_per_file=1000000):
+        self.prefix = prefix
+        self.header = [column for column, column_type in columns]
+        self.rows_per_file = rows_per_file
+        self.parts = 0
+        self.rows_in_part = 0
+        self.f = None
+
+    def write_rows(self, rows):
+        for row in rows:
+            if self.f is None or self.rows_in_part >= self.rows_per_file:
+                self.next_part()
+
+            self.writer.writerow([csv_value(value) for value in row])
+            self.rows_in_part = self.rows_in_part + 1
+
+    def next_part(self):
+        self.close()
+
+        self.f = open("%s-%05d.csv" % (self.prefix, self.parts), 'wb')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(self.header)
+        self.parts = self.parts + 1
+        self.rows_in_part = 0
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+
+def csv_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if value is None:
+        return ''
+
+    return value
+
+
+class ArrowWriter(object):
+    """
+    Writes each chunk of rows as a Parquet row group or an Arrow IPC
+    record batch, with the column types given in DATASETS.
+    """
+
+    def __init__(self, path, columns, file_format='parquet'):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            logger.error("pyarrow is needed for %s output" % file_format)
+            print('pyarrow is needed for %s output' % file_format)
+            sys.exit(1)
+
+        self.pyarrow = pyarrow
+        types = {'int': pyarrow.int64(), 'string': pyarrow.string(),
+                 'bool': pyarrow.bool_()}
+        self.schema = pyarrow.schema([pyarrow.field(column, types[column_type])
+                                      for column, column_type in columns])
+
+        if file_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.sink = pyarrow.OSFile(path, 'wb')
+            self.writer = pyarrow.RecordBatchFileWriter(self.sink,
+                                                        self.schema)
+
+        self.file_format = file_format
+
+    def write_rows(self, rows):
+        arrays = [self.pyarrow.array(list(values), type=field.type)
+                  for values, field in zip(zip(*rows), self.schema)]
+
+        if self.file_format == 'parquet':
+            self.writer.write_table(self.pyarrow.Table.from_arrays(
+                arrays, schema=self.schema))
+        else:
+            self.writer.write_batch(self.pyarrow.RecordBatch.from_arrays(
+                arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+        if self.file_format != 'parquet':
+            self.sink.close()
+
+
+def export_dataset(db_conn, name, output_path, formats, run_id,
+                   params, chunk_size=10000, rows_per_file=1000000):
+    # Stream one dataset out to every requested format. Returns the
+    # number of rows and the key of the last one.
+    columns = DATASETS[name][0]
+    dataset_path = os.path.join(output_path, name)
+
+    if not os.path.exists(dataset_path):
+        os.makedirs(dataset_path)
+
+    prefix = os.path.join(dataset_path, "%s-%s" % (name, run_id))
+
+    if name in FENCED:
+        params = dict(params, fence=schema.committed_changes(db_conn))
+    writers = []
+
+    for file_format in formats:
+        if file_format == 'csv':
+            writers.append(CSVWriter(prefix, columns, rows_per_file))
+        else:
+            extension = 'parquet' if file_format == 'parquet' else 'arrow'
+            writers.append(ArrowWriter("%s.%s" % (prefix, extension),
+                                       columns, file_format))
+
+    # A named cursor keeps the result set on the server; we only ever
+    # hold chunk_size rows
+    cur = db_conn.cursor(name="export_%s" % name)
+    cur.itersize = chunk_size
+    cur.execute(export_query(name, params.get('fork'), params.get('min_id'),
+                             params.get('max_id')), params)
+
+    exported = 0
+    last_id = params['last_id']
+
+    while True:
+        with metrics.timer('export.fetch'):
+            rows = cur.fetchmany(chunk_size)
+
+        if not rows:
+            break
+
+        with metrics.timer('export.write'):
+            for writer in writers:
+                writer.write_rows(rows)
+
+        exported = exported + len(rows)
+        last_id = rows[-1][0]
+
+        logger.info("Exported %s %s rows" % (exported, name))
+
+    cur.close()
+    db_conn.commit()
+
+    if name in FENCED:
+        last_id = max(last_id, params['fence'])
+
+    for writer in writers:
+        writer.close()
+
+    metrics.count('export.rows.%s' % name, exported)
+
+    return exported, last_id
+
+
+def load_state(path):
+    # Dataset -> key of the last row exported
+    if not os.path.exists(path):
+        return {}
+
+    f = open(path, 'r')
+    state = json.loads(f.read())
+    f.close()
+
+    return state
+
+
+def save_state(path, state):
+    tmp_path = "%s.tmp" % path
+
+    f = open(tmp_path, 'w')
+    f.write(json.dumps(state, indent=1, sort_keys=True))
+    f.close()
+
+    os.rename(tmp_path, path)
+
+
+if __name__ == "__main__":
+    # Parse the yaml config file
+    config_file = open('config.yaml', 'r')
+    config = yaml.load(config_file.read())
+
+    parser = optparse.OptionParser()
+
+    parser.add_option('-o', '--output',
+                      action="store", dest="output",
+                      help="""Directory to export into; each dataset gets a
+                              subdirectory""",
+                      default="exports")
+
+    parser.add_option('-f', '--formats',
+                      action="store", dest="formats",
+                      help="""Comma-separated output formats: csv, parquet,
+                              arrow""",
+                      default="csv")
+
+    parser.add_option('-d', '--datasets',
+                      action="store", dest="datasets",
+                      help="""Comma-separated datasets to export (default:
+                              %s)""" % ", ".join(sorted(DATASETS)),
+                      default=",".join(sorted(DATASETS)))
+
+    parser.add_option('--fork',
+                      action="store", dest="fork",
+                      type="choice", choices=['all', 'yes', 'no'],
+                      help="""Only export forks ('yes'), non-forks ('no')
+                              or both ('all')""",
+                      default='all')
+
+    parser.add_option('--min_id',
+                      action="store", dest="min_id", type="int",
+                      help="""Only export repositories with ids from this""",
+                      default=None)
+
+    parser.add_option('--max_id',
+                      action="store", dest="max_id", type="int",
+                      help="""Only export repositories with ids up to this""",
+                      default=None)
+
+    parser.add_option('-i', '--incremental',
+                      action="store_true", dest="incremental",
+                      help="""Only export rows added since the last
+                              --incremental export into this directory""",
+                      default=False)
+
+    parser.add_option('--chunk_size',
+                      action="store", dest="chunk_size", type="int",
+                      help="""Rows fetched from the database at a time""",
+                      default=10000)
+
+    parser.add_option('--rows_per_file',
+                      action="store", dest="rows_per_file", type="int",
+                      help="""Rows per CSV file""",
+                      default=1000000)
+
+    options, args = parser.parse_args()
+
+    # Initialize log file
+    logging.basicConfig(filename='export.log', level=logging.ERROR)
+    logger.setLevel(logging.DEBUG)
+
+    formats = [f.strip() for f in options.formats.split(',') if f.strip()]
+    datasets = [d.strip() for d in options.datasets.split(',') if d.strip()]
+
+    for file_format in formats:
+        if not file_format in ['csv', 'parquet', 'arrow']:
+            parser.error("Unknown format %s" % file_format)
+
+    for name in datasets:
+        if not name in DATASETS:
+            parser.error("Unknown dataset %s" % name)
+
+    if not os.path.exists(options.output):
+        os.makedirs(options.output)
+
+    state_path = os.path.join(options.output, 'export_state.json')
+    state = load_state(state_path) if options.incremental else {}
+    run_id = "%s-%s" % (time.strftime('%Y%m%d%H%M%S'), os.getpid())
+
+    db_conn = psycopg2.connect(database=config['static_database'],
+                               user=config['static_database_user'],
+                               password=config['static_database_password'])
+
+    for name in datasets:
+        params = {'last_id': state.get(name, 0),
+                  'fork': {'yes': True, 'no': False}.get(options.fork),
+                  'min_id': options.min_id,
+                  'max_id': options.max_id}
+
+        try:
+            exported, last_id = export_dataset(db_conn, name, options.output,
+                                               formats, run_id, params,
+                                               options.chunk_size,
+                                               options.rows_per_file)
+        except psycopg2.DatabaseError, e:
+            db_conn.rollback()
+
+            logger.error('Error %s when exporting %s' % (e, name))
+            db_conn.close()
+            sys.exit(1)
+
+        print('Exported %s %s rows' % (exported, name))
+
+        # Only remember how far we got once the dataset is fully written
+        if options.incremental:
+            state[name] = last_id
+            save_state(state_path, state)
+
+    db_conn.close()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# In-process license classifier: matches files against a local corpus of
+# reference license texts by the word n-grams they share
+
+import os
+import re
+import zlib
+import hashlib
+import numpy
+
+word_re = re.compile(r"[a-z0-9]+")
+
+# Bump when shingling or scoring changes
+VERSION = 2
+
+
+def shingles(text, n=5):
+    # Hashes of every run of n words, lowercased and without punctuation,
+    # so wrapping and formatting differences don't matter
+    words = word_re.findall(text.lower())
+
+    if len(words) < n:
+        return numpy.array([], dtype=numpy.uint32)
+
+    hashes = [zlib.crc32(u" ".join(words[i:i + n]).encode('utf-8'))
+              & 0xffffffff for i in range(len(words) - n + 1)]
+
+    return numpy.unique(numpy.array(hashes, dtype=numpy.uint32))
+
+
+class FingerprintClassifier(object):
+    """
+    Index of reference license texts. Each file in the reference
+    directory is one license, named after the abbreviation it should map
+    to (e.g. 'MIT.txt', 'GPL-2.0.txt'). A file matches a license when it
+    contains at least `threshold` of that license's n-grams, unless that
+    license's text is largely part of a better match's (BSD-2-Clause in
+    BSD-3-Clause, say). `version` changes with the algorithm, the
+    parameters and the reference texts.
+    """
+
+    def __init__(self, reference_path, threshold=0.8, n=5):
+        self.threshold = threshold
+        self.n = n
+        self.abbrs = []
+        self.references = []
+        self.overlaps = {}
+
+        hashes = []
+        owners = []
+        digest = hashlib.sha1("%s %s" % (threshold, n))
+
+        for filename in sorted(os.listdir(reference_path)):
+            f = open(os.path.join(reference_path, filename), 'r')
+            text = f.read()
+            f.close()
+
+            digest.update(filename)
+            digest.update(text)
+            text = text.decode('utf-8', 'replace')
+
+            license_hashes = shingles(text, n)
+
+            if not len(license_hashes):
+                continue
+
+            self.references.append(license_hashes)
+            hashes.append(license_hashes)
+            owners.append(numpy.repeat(len(self.abbrs), len(license_hashes)))
+            self.abbrs.append(os.path.splitext(filename)[0])
+
+        # One flat array of every reference n-gram plus the index of the
+        # license it came from, so a file is scored against all references
+        # in a few vector operations
+        if hashes:
+            self.hashes = numpy.concatenate(hashes)
+            self.owners = numpy.concatenate(owners)
+        else:
+            self.hashes = numpy.array([], dtype=numpy.uint32)
+            self.owners = numpy.array([], dtype=numpy.int64)
+
+        self.version = "%s-%s" % (VERSION, digest.hexdigest()[:12])
+        self.sizes = numpy.bincount(self.owners,
+                                    minlength=len(self.abbrs))
+
+    def scores(self, text):
+        # Fraction of each reference license's n-grams found in the text
+        file_hashes = shingles(text, self.n)
+
+        if not len(file_hashes) or not len(self.abbrs):
+            return numpy.zeros(len(self.abbrs))
+
+        found = numpy.in1d(self.hashes, file_hashes)
+        hits = numpy.bincount(self.owners, weights=found,
+                              minlength=len(self.abbrs))
+
+        return hits / self.sizes
+
+    def overlap(self, i, j):
+        # Fraction of reference i's n-grams that are also in reference j
+        if not (i, j) in self.overlaps:
+            self.overlaps[(i, j)] = numpy.in1d(self.references[i],
+                                               self.references[j]).mean()
+
+        return self.overlaps[(i, j)]
+
+    def classify(self, text):
+        # Abbreviations of the references matched, best first, leaving
+        # out those a better match already accounts for
+        scores = self.scores(text)
+        matched = numpy.nonzero(scores >= self.threshold)[0]
+        matched = sorted(matched, key=lambda i: scores[i], reverse=True)
+        kept = []
+
+        for i in matched:
+            if not [j for j in kept if self.overlap(i, j) >= self.threshold]:
+                kept.append(i)
+
+        return [self.abbrs[i] for i in kept]
@@ -7,20 +7,70 @@ import optparse
 import time
 import yaml
 import link_header
+import db_writer
+import credentials
+import shards
+import archive
+import blobs
+import metrics
 import re
 import logging
 import psycopg2
 import sys
-from urlparse import urljoin
-from base64 import b64decode
+import os
+import hashlib
+import threading
+import Queue
+from multiprocessing.dummy import Pool as ThreadPool
+from urlparse import urljoin, urlparse, parse_qs
+from base64 import b64decode, b64encode
 
 config = None
+api_url = "https://api.github.com"
 requests_left = 60
+rate_limit_lock = threading.Lock()
+session = requests.Session()
+scheduler = None
+cache_path = None
+cache_lock = threading.Lock()
+cache_stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+
+# Every response is appended to archive_writer when it's set; when
+# replay_archive is set responses come from it instead of the API
+archive_writer = None
+replay_archive = None
+
+# Git SHAs of license blobs whose content is already stored
+known_shas = set()
 license_pattern = re.compile(r"""\b(copying|license|licence|licensing|gnu|gpl|
                                  gplv2|gplv3|lgpl|lgplv2|lgplv3|agpl|agplv2|
                                  agplv3|apache|apl|bsd|cddl|mit|mozilla|mpl|
                                  mplv2|eclipse|epl|qpl|isc)\b""",\
                                  re.IGNORECASE)
+readme_pattern = re.compile(r"readme(\.|$)", re.IGNORECASE)
+
+# How license files are found: 'contents' walks the REST contents API
+# (2 + N requests per repo), 'graphql' asks for the root tree and file
+# text of a batch of repos in one query
+discovery = 'contents'
+graphql_batch_size = 20
+graphql_repo_query = """
+  %(alias)s: repository(owner: %(owner)s, name: %(name)s) {
+    url
+    defaultBranchRef { name }
+    object(expression: "HEAD:") {
+      ... on Tree {
+        entries {
+          name
+          type
+          oid
+          object {
+            ... on Blob { byteSize isBinary isTruncated text }
+          }
+        }
+      }
+    }
+  }"""
 
 def get_repo(repo_url):
     r = api_request(repo_url)
@@ -31,6 +81,15 @@ def get_repo(repo_url):
 
     return None
 
+class LicenseFetchError(Exception):
+    pass
+
+def check_fetch(r):
+    # Missing files (404), empty repos (409) and blocked repos (451) are
+    # answers; server errors and rate limiting mean we should try again
+    if r.status_code >= 500 or r.status_code in (403, 429):
+        raise LicenseFetchError("%s returned %s" % (r.url, r.status_code))
+
 def get_repo_licenses(repo_url):
     global license_pattern
     license_files = {}
@@ -40,6 +99,7 @@ def get_repo_licenses(repo_url):
 
     # Iterate over files in TLD to look for license-ish filenames
     r = api_request(base_url)
+    check_fetch(r)
     if(r.ok):
         base_dir = json.loads(r.text or r.content)
 
@@ -49,38 +109,440 @@ def get_repo_licenses(repo_url):
 
                 # Run through each pattern...
                 if license_pattern.search(afile['name']):
-                    license_path = "%s%s" % (base_url, afile['name'])                    
-                    file_r = api_request(license_path)
-                    if(file_r.ok):
-                        license_obj = json.loads(file_r.text or\
-                                                     file_r.content)
+                    license_path = "%s%s" % (base_url, afile['name'])
+                    license_obj = get_license_file(license_path, afile)
+
+                    if license_obj:
                         license_files[afile['name']] = license_obj
 
     # Tack on the README file
     r = api_request(readme_url)
+    check_fetch(r)
     if(r.ok):
         readme_file = json.loads(r.text or r.content)
         license_files[readme_file['name']] = readme_file
 
     return license_files
 
-def api_request(url):
+def get_license_file(url, afile):
+    # The /contents/ object for a listed file, or None if it's gone. We
+    # don't fetch blobs we already have from another repo; the listing
+    # has everything but the content. A replay may not have them yet when
+    # the crawl did, so then any recorded copy of the blob stands in.
+    content = None
+
+    if not afile['sha'] in known_shas:
+        if replay_archive and not replay_archive.recorded(url):
+            content = replay_archive.blob_content(afile['sha'])
+
+        if content is None:
+            file_r = api_request(url)
+            check_fetch(file_r)
+
+            if not file_r.ok:
+                return None
+
+            return json.loads(file_r.text or file_r.content)
+
+    license_obj = dict(afile)
+    license_obj['encoding'] = 'base64'
+    license_obj['content'] = content
+
+    return license_obj
+
+def get_changed_licenses(repo_url, stored):
+    # Re-list a stored repo's root directory and compare the SHAs of its
+    # license-ish files and README with the stored ones (path -> (license
+    # id, sha, deleted)), fetching only files that are new or changed.
+    # Returns (new files, [(license id, changed file)], deleted license
+    # ids). A file that comes back after being deleted counts as changed.
+    # Files we only have from subdirectories (some READMEs) are left be.
+    base_url = "%s/contents/" % repo_url
+
+    r = api_request(base_url)
+    check_fetch(r)
+
+    if r.status_code in (404, 409):
+        # The repo is gone or empty now
+        files = []
+    elif not r.ok:
+        raise LicenseFetchError("%s returned %s" % (r.url, r.status_code))
+    else:
+        files = [afile for afile in json.loads(r.text or r.content)
+                 if afile['type'] == 'file']
+
+    candidates = [afile for afile in files
+                  if license_pattern.search(afile['name'])]
+    readmes = [afile for afile in files
+               if readme_pattern.match(afile['name']) and
+               not license_pattern.search(afile['name'])]
+
+    # The crawl stored one README; keep following that one, or pick the
+    # repo's README again if it's been renamed or removed. We can't tell
+    # whether one from a subdirectory is still there, so that one stays.
+    kept = [afile for afile in readmes if afile['path'] in stored and
+            not stored[afile['path']][2]]
+    nested = [path for path in stored if '/' in path and
+              readme_pattern.match(path.split('/')[-1]) and
+              not stored[path][2]]
+
+    if kept:
+        candidates.extend(kept)
+    elif readmes and not nested:
+        candidates.append(readmes[0])
+
+    new_files = []
+    changed_files = []
+
+    for afile in candidates:
+        license_id, sha, deleted = stored.get(afile['path'],
+                                              (None, None, False))
+
+        if license_id is not None and sha == afile['sha'] and not deleted:
+            continue
+
+        license_obj = get_license_file("%s%s" % (base_url, afile['name']),
+                                       afile)
+
+        if not license_obj:
+            continue
+
+        if license_id is not None:
+            changed_files.append((license_id, license_obj))
+        else:
+            new_files.append(license_obj)
+
+    paths = set([afile['path'] for afile in files])
+    deleted_ids = [stored[path][0] for path in stored
+                   if not '/' in path and not path in paths and
+                   not stored[path][2]]
+
+    return new_files, changed_files, deleted_ids
+
+def try_changed_licenses(args):
+    # Returns None if the repo couldn't be checked
+    try:
+        with metrics.stage('refresh_licenses'):
+            with metrics.timer('refresh.repo_check'):
+                return get_changed_licenses(*args)
+    except LicenseFetchError, e:
+        metrics.count('refresh.check_failed')
+        logger.error('Could not check license files: %s' % e)
+        return None
+
+def get_repos_licenses_graphql(repos):
+    # Fetch the root directory listing and the text of every license-ish
+    # file and README for a batch of repos in a single GraphQL query. The
+    # results are shaped like the /contents/ objects get_repo_licenses
+    # returns so they can be stored the same way.
+    query = "query {%s\n}" % "".join(
+        [graphql_repo_query % {'alias': "r%s" % i,
+                               'owner': json.dumps(repo['full_name'].split('/')[0]),
+                               'name': json.dumps(repo['full_name'].split('/')[1])}
+         for i, repo in enumerate(repos)])
+
+    r = api_request("%s/graphql" % api_url, data={'query': query},
+                    resource='graphql')
+    check_fetch(r)
+
+    if not r.ok:
+        raise LicenseFetchError("%s returned %s" % (r.url, r.status_code))
+
+    result = json.loads(r.text or r.content)
+
+    if not result.get('data'):
+        raise LicenseFetchError("GraphQL query failed: %s" % \
+                                    result.get('errors'))
+
+    repos_licenses = []
+
+    for i, repo in enumerate(repos):
+        repo_item = result['data'].get("r%s" % i)
+        license_files = {}
+        readme_file = None
+
+        # Missing repos and empty repos have no files
+        if repo_item and repo_item['object']:
+            for entry in repo_item['object']['entries']:
+                blob = entry['object']
+
+                if entry['type'] != 'blob' or not blob or blob['isBinary']:
+                    continue
+
+                if license_pattern.search(entry['name']):
+                    license_obj = graphql_license_obj(repo['url'], repo_item,
+                                                      entry)
+
+                    if license_obj:
+                        license_files[entry['name']] = license_obj
+                elif readme_file is None and readme_pattern.match(entry['name']):
+                    readme_file = graphql_license_obj(repo['url'], repo_item,
+                                                      entry)
+
+        # Tack on the README file
+        if readme_file:
+            license_files[readme_file['name']] = readme_file
+
+        repos_licenses.append(license_files)
+
+    return repos_licenses
+
+def graphql_license_obj(repo_url, repo_item, entry):
+    # GitHub truncates the text of large blobs, and decodes them as UTF-8,
+    # losing bytes that aren't. Stored under the blob's SHA that text
+    # would stand in for every other copy of the file, so unless it hashes
+    # back to the SHA the file comes from the contents API instead.
+    # Returns None if that fails.
+    blob = entry['object']
+    self_url = "%s/contents/%s" % (repo_url, entry['name'])
+    branch = (repo_item.get('defaultBranchRef') or {}).get('name') or 'HEAD'
+    content = None
+
+    # Known blobs aren't stored again
+    if not entry['oid'] in known_shas:
+        data = None
+
+        if not blob.get('isTruncated') and blob['text'] is not None:
+            data = blob['text'].encode('utf-8')
+
+            if blobs.git_sha(data) != entry['oid']:
+                metrics.count('crawl.graphql_mismatch')
+                data = None
+
+        if data is None and replay_archive and \
+                not replay_archive.recorded(self_url):
+            content = replay_archive.blob_content(entry['oid'])
+
+        if data is None and content is None:
+            metrics.count('crawl.graphql_fallback')
+
+            file_r = api_request(self_url)
+            check_fetch(file_r)
+
+            if not file_r.ok:
+                return None
+
+            return json.loads(file_r.text or file_r.content)
+
+        if data is not None:
+            content = b64encode(data)
+
+    return {'type': 'file',
+            'encoding': 'base64',
+            'name': entry['name'],
+            'path': entry['name'],
+            'size': blob['byteSize'],
+            'sha': entry['oid'],
+            'content': content,
+            '_links': {'self': self_url,
+                       'html': "%s/blob/%s/%s" % (repo_item['url'], branch,
+                                                  entry['name'])}}
+
+def try_graphql_licenses(repos):
+    # Returns None for every repo in the batch if the query failed. The
+    # stage is marked here, on the pool thread doing the work, since
+    # cProfile only follows the thread that enabled it.
+    try:
+        with metrics.stage('fetch_licenses'):
+            with metrics.timer('crawl.batch_fetch'):
+                return get_repos_licenses_graphql(repos)
+    except LicenseFetchError, e:
+        metrics.count('crawl.fetch_failed', len(repos))
+        logger.error('Could not fetch license files: %s' % e)
+        return [None] * len(repos)
+
+def try_repo_licenses(repo_url):
+    # Returns None if the license files couldn't be fetched
+    try:
+        with metrics.stage('fetch_licenses'):
+            with metrics.timer('crawl.repo_fetch'):
+                return get_repo_licenses(repo_url)
+    except LicenseFetchError, e:
+        metrics.count('crawl.fetch_failed')
+        logger.error('Could not fetch license files: %s' % e)
+        return None
+
+def get_licenses_for_repos(repos, concurrency=1):
+    # Fetch the license files for a page of repos, spreading the work
+    # over a pool of worker threads. Results come back in repo order.
+    if discovery == 'graphql':
+        batches = [repos[i:i + graphql_batch_size]
+                   for i in range(0, len(repos), graphql_batch_size)]
+        results = run_pool(try_graphql_licenses, batches, concurrency)
+
+        return [licenses for batch in results for licenses in batch]
+
+    return run_pool(try_repo_licenses, [repo['url'] for repo in repos],
+                    concurrency)
+
+def run_pool(func, items, concurrency=1):
+    if concurrency <= 1 or len(items) <= 1:
+        return map(func, items)
+
+    pool = ThreadPool(min(concurrency, len(items)))
+
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def acquire_credential(resource='core'):
+    # Workers share the credentials' rate limit budgets; when they're all
+    # used up only one worker waits for the reset while the others block
+    # on the lock
+    while True:
+        credential = scheduler.acquire(resource)
+
+        if credential is not None:
+            return credential
+
+        with metrics.timer('rate_limit.blocked'):
+            with rate_limit_lock:
+                if scheduler.exhausted(resource):
+                    wait_for_rate_limit_reset(resource)
+
+def init_session(pool_size=10):
+    # One pooled session so connections are kept alive between requests
+    global session
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+def cache_file(url):
+    return os.path.join(cache_path, hashlib.sha1(url).hexdigest())
+
+def cache_lookup(url):
+    # Return the cached ETag/Last-Modified/body for a URL, if we have one
+    if not cache_path:
+        return None
+
+    path = cache_file(url)
+
+    if not os.path.exists(path):
+        return None
+
+    try:
+        f = open(path, 'r')
+        entry = json.loads(f.read())
+        f.close()
+    except (IOError, ValueError):
+        return None
+
+    return entry
+
+def cache_store(url, r):
+    if not cache_path:
+        return
+
+    etag = r.headers.get('ETag')
+    last_modified = r.headers.get('Last-Modified')
+
+    if not (etag or last_modified):
+        return
+
+    entry = {'url': url,
+             'etag': etag,
+             'last_modified': last_modified,
+             'link': r.headers.get('link'),
+             'body': r.text}
+
+    # Write to a temp file and rename so readers never see partial entries
+    path = cache_file(url)
+    tmp_path = "%s.%s.tmp" % (path, threading.current_thread().ident)
+
+    f = open(tmp_path, 'w')
+    f.write(json.dumps(entry))
+    f.close()
+
+    os.rename(tmp_path, path)
+
+def count_cache(stat):
+    with cache_lock:
+        cache_stats[stat] += 1
+
+def log_cache_stats():
+    if cache_path:
+        logger.info("Response cache: %s hits, %s misses, %s not modified" % \
+                        (cache_stats['hits'], cache_stats['misses'],
+                         cache_stats['not_modified']))
+
+def api_request(url, use_cache=True, credential=None, data=None,
+                resource='core'):
     global requests_left
 
-    u = config['github_user'] 
-    p = config['github_password']
+    if replay_archive:
+        metrics.count('replay.requests')
+        r = replay_archive.response(url, data)
+
+        if r.reason == archive.NOT_RECORDED:
+            metrics.count('replay.missing')
+            logger.error("%s isn't in the archive" % url)
+
+        return r
+
+    if credential is None:
+        credential = acquire_credential(resource)
+
+    # POSTs (GraphQL queries) aren't cached
+    if data is not None:
+        use_cache = False
+
+    entry = None
+    headers = dict(credential['headers'])
     r = None
 
+    # Send a conditional request if we've seen this URL before; GitHub
+    # doesn't count 304 responses against the rate limit
+    if use_cache:
+        entry = cache_lookup(url)
+
+        if entry:
+            count_cache('hits')
+
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        elif cache_path:
+            count_cache('misses')
+
     while True:
 
         try:
-            if(u and p):
-                r = requests.get(url, auth=(u, p))
-            else:
-                r = requests.get(url)
+            with metrics.timer('api.request'):
+                if data is not None:
+                    r = session.post(url, data=json.dumps(data),
+                                     headers=headers, auth=credential['auth'])
+                else:
+                    r = session.get(url, headers=headers,
+                                    auth=credential['auth'])
 
-            if(r.ok):
-                requests_left = int(r.headers['X-RateLimit-Remaining'])
+            metrics.count('api.status.%s' % r.status_code)
+
+            scheduler.update(credential, r)
+
+            if r.status_code == 304 and entry:
+                count_cache('not_modified')
+
+                # Serve the cached body as if it were a fresh response
+                r.status_code = 200
+                r.encoding = 'utf-8'
+                r._content = entry['body'].encode('utf-8')
+
+                if entry['link'] and not 'link' in r.headers:
+                    r.headers['link'] = entry['link']
+            elif r.ok and use_cache:
+                cache_store(url, r)
+
+            if archive_writer:
+                with metrics.timer('archive.write'):
+                    archive_writer.record(url, r, data)
+
+            requests_left = scheduler.remaining()
 
             return r
         except requests.exceptions.ConnectionError, e:
@@ -93,21 +555,401 @@ def api_request(url):
             sys.exit(1)
 
 
-def wait_for_rate_limit_reset():
+def wait_for_rate_limit_reset(resource='core'):
     global requests_left
 
-    # If we're out of requests, sleep in 5-minute increments
+    # Check each credential's budget (rate_limit calls are free), then if
+    # they're all used up sleep until the earliest one resets
     while True:
-        r = api_request("https://api.github.com/rate_limit")
+        for credential in scheduler.credentials:
+            r = api_request("%s/rate_limit" % api_url,
+                            use_cache=False, credential=credential)
 
-        if r.ok:
-            requests_left = int(r.headers['X-RateLimit-Remaining'])
+            if r.ok:
+                resources = json.loads(r.text or r.content)['resources']
 
-        if r.status_code != 200 or requests_left < 10:
-            logger.info("Waiting for rate limit to reset...")
-            time.sleep(300)
-        else:
+                for name in resources:
+                    scheduler.set_limit(credential, name,
+                                        resources[name]['remaining'],
+                                        resources[name]['reset'])
+
+        requests_left = scheduler.remaining()
+
+        if not scheduler.exhausted(resource):
+            break
+
+        wait = scheduler.reset_wait(resource)
+        logger.info("Waiting %s seconds for rate limit to reset..." % wait)
+
+        with metrics.timer('rate_limit.wait'):
+            time.sleep(wait)
+        
+
+def store_licenses(writer, repos, concurrency=1):
+    # Fetch and buffer the license files for a list of repos, recording
+    # which ones will need another try
+    repos_licenses = get_licenses_for_repos(repos, concurrency)
+
+    for repo, licenses in zip(repos, repos_licenses):
+        if licenses is None:
+            writer.set_status(repo['id'], 'failed')
+            continue
+
+        for license_name in licenses:
+            alicense = licenses[license_name]
+
+            # Only the first copy of a blob keeps its content
+            if alicense['sha'] in known_shas:
+                alicense['content'] = None
+
+            logger.info("Storing license: %s" % license_name)
+            writer.add_license(repo['id'], alicense)
+
+        writer.set_status(repo['id'], 'done')
+        metrics.count('crawl.repos_fetched')
+
+def remember_shas(writer):
+    # Called once a page is committed, so a SHA is only "known" when its
+    # content is safely in the DB
+    for sha in writer.stored_shas:
+        known_shas.add(sha)
+
+class ListingError(Exception):
+    pass
+
+def page_url(since):
+    return "%s/repositories?since=%s" % (api_url, since)
+
+def list_page(url):
+    # Fetch a page of /repositories, waiting out rate limits and
+    # retrying auth hiccups
+    while True:
+        with metrics.stage('list_page'):
+            r = api_request(url)
+
+        logger.info("Request status: %s" % r.status_code)
+
+        if r.status_code == 401:
+            logger.info("Got a 401. Retrying...")
+            time.sleep(60)
+            continue
+
+        if r.status_code in (403, 429):
+            if scheduler.exhausted():
+                wait_for_rate_limit_reset()
+            else:
+                time.sleep(60)
+            continue
+
+        if not r.ok:
+            raise ListingError("Listing %s failed with status %s" % \
+                                   (url, r.status_code))
+
+        if scheduler.exhausted():
+            wait_for_rate_limit_reset()
+
+        return r
+
+def next_page_url(r, url, repos_json):
+    # The cursor is the id of the last repo on the page, so we don't need
+    # the Link header to know the next URL, but if the header disagrees
+    # it wins. Returns the URL and whether the API has more pages.
+    links = link_header.parse_link_value(r.headers.get('link'))
+    link_next = None
+
+    for link_url in links:
+        if links[link_url].get('rel') == 'next':
+            link_next = link_url
+
+    if not repos_json:
+        return link_next or url, bool(link_next)
+
+    next_url = page_url(repos_json[-1]['id'])
+
+    if link_next:
+        since = parse_qs(urlparse(link_next).query).get('since', [None])[0]
+
+        if since != str(repos_json[-1]['id']):
+            logger.error("Link header cursor %s differs from last repo "\
+                         "#%s; following the header" % \
+                             (link_next, repos_json[-1]['id']))
+            metrics.count('crawl.cursor_diverged')
+            next_url = link_next
+
+    return next_url, bool(link_next)
+
+def list_pages(url, end_id=None):
+    # Yield (repos, next_url, done) for each page of /repositories from
+    # url on, until the listing or the repos up to end_id run out.
+    # next_url is where the crawl should resume after the page.
+    done = False
+
+    while not done:
+        r = list_page(url)
+        repos_json = json.loads(r.text or r.content)
+        next_url, has_next = next_page_url(r, url, repos_json)
+
+        if end_id is not None:
+            page_size = len(repos_json)
+            repos_json = [repo for repo in repos_json if repo['id'] <= end_id]
+            has_next = has_next and bool(repos_json) and \
+                len(repos_json) == page_size and repos_json[-1]['id'] < end_id
+
+        done = not repos_json or not has_next
+
+        yield repos_json, next_url, done
+
+        url = next_url
+
+def prefetch(pages, depth=2):
+    # Run a page iterator on its own thread, up to `depth` pages ahead,
+    # so the next pages are listed while the licenses of this one are
+    # fetched. Errors are raised here, in the consuming thread. If the
+    # consumer stops early the lister stops too.
+    if depth < 1:
+        for page in pages:
+            yield page
+        return
+
+    queue = Queue.Queue(depth)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put(('page', page)):
+                    return
+            put(('end', None))
+        except Exception, e:
+            put(('error', e))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            with metrics.timer('crawl.page_wait'):
+                kind, value = queue.get()
+
+            if kind == 'end':
+                return
+            if kind == 'error':
+                raise value
+
+            yield value
+    finally:
+        stopped.set()
+
+def process_page(writer, repos_json, next_url, concurrency=1,
+                 cursor_name='repositories'):
+    # Store a page of repos and the license files of the new ones in a
+    # single transaction, along with where to resume the crawl
+    for repo in repos_json:
+        # Log the effort to store this repo's information:
+        logger.info("Storing repository #%s: %s (Fork? %s)" % \
+                        (repo['id'], repo['full_name'], repo['fork']))
+
+    try:
+        with metrics.stage('store'):
+            new_repos = writer.store_repos(repos_json)
+
+        logger.info("%s of %s repositories are new" % \
+                        (len(new_repos), len(repos_json)))
+
+        # Find likely license files for the new repos
+        store_licenses(writer, new_repos, concurrency)
+
+        if repos_json and cursor_name:
+            writer.set_cursor(cursor_name, next_url, repos_json[-1]['id'])
+
+        with metrics.stage('store'):
+            writer.flush()
+
+        remember_shas(writer)
+        metrics.count('crawl.pages')
+        metrics.count('crawl.repos_listed', len(repos_json))
+
+    except psycopg2.DatabaseError, e:
+
+        # Unhandled errors dump us 
+        writer.rollback()
+
+        logger.error('Error %s when storing page of repos starting with %s'\
+                         % (e, repos_json[0]['full_name']))
+        writer.db_conn.close()
+        sys.exit(1)
+
+def retry_failed_repos(writer, concurrency=1):
+    # Fetch license files for repos that failed last time, without
+    # listing their pages again
+    repos = writer.failed_repos()
+
+    logger.info("Retrying license files for %s repositories" % len(repos))
+
+    for i in range(0, len(repos), 100):
+        try:
+            store_licenses(writer, repos[i:i + 100], concurrency)
+            writer.flush()
+            remember_shas(writer)
+        except psycopg2.DatabaseError, e:
+            writer.rollback()
+
+            logger.error('Error %s when retrying license files' % e)
+            writer.db_conn.close()
+            sys.exit(1)
+
+def crawl_shard(writer, shard, worker, concurrency=1, depth=2):
+    # Crawl the repos with ids in (start_id, end_id] from where the shard
+    # was left, saving its progress with each page. Returns False if the
+    # API gave up on us; the shard's lease then runs out and it's claimed
+    # again later. If another worker has taken the shard over we leave
+    # it to them.
+    shard_id, start_id, end_id, since = shard
+
+    logger.info("Crawling shard #%s: repositories %s to %s from %s" % \
+                    (shard_id, start_id, end_id, since))
+
+    try:
+        for repos_json, next_url, done in \
+                prefetch(list_pages(page_url(since), end_id), depth):
+            if repos_json:
+                since = repos_json[-1]['id']
+
+            writer.set_shard_progress(shard_id, worker, since, done)
+
+            if repos_json:
+                process_page(writer, repos_json, None, concurrency,
+                             cursor_name=None)
+            else:
+                writer.flush()
+
+            log_cache_stats()
+    except ListingError, e:
+        logger.error(e)
+        return False
+    except shards.ShardLost, e:
+        logger.error(e)
+        metrics.count('crawl.shards_lost')
+        return True
+
+    logger.info("Finished shard #%s" % shard_id)
+    metrics.count('crawl.shards')
+
+    return True
+
+def run_shard_worker(writer, concurrency=1, depth=2):
+    # Claim and crawl shards until none are left
+    worker = shards.worker_name()
+
+    while True:
+        shard = shards.claim_shard(writer.db_conn, worker)
+
+        if not shard:
+            logger.info("No shards left to claim: %s" % \
+                            shards.shard_progress(writer.db_conn))
+            break
+
+        if not crawl_shard(writer, shard, worker, concurrency, depth):
             break
+
+def refresh_repos(writer, concurrency=1, batch_size=100):
+    # Re-check stored repos for new, changed and deleted license files,
+    # least recently checked first, until every repo checked before this
+    # run started has been seen again. Repos that can't be checked keep
+    # their checked_at, so the next run tries them first.
+    started = writer.now()
+    failed = []
+
+    while True:
+        repos = writer.unchecked_repos(started, failed, batch_size)
+
+        if not repos:
+            break
+
+        stored = writer.stored_licenses([repo['id'] for repo in repos])
+
+        results = run_pool(try_changed_licenses,
+                           [(repo['url'], stored.get(repo['id'], {}))
+                            for repo in repos], concurrency)
+
+        for repo, result in zip(repos, results):
+            if result is None:
+                failed.append(repo['id'])
+                continue
+
+            writer.set_checked(repo['id'])
+
+            new_files, changed_files, deleted_ids = result
+
+            for alicense in new_files:
+                if alicense['sha'] in known_shas:
+                    alicense['content'] = None
+
+                writer.add_license(repo['id'], alicense)
+
+            for license_id, alicense in changed_files:
+                if alicense['sha'] in known_shas:
+                    alicense['content'] = None
+
+                writer.replace_license(license_id, repo['id'], alicense)
+
+            for license_id in deleted_ids:
+                writer.mark_deleted(license_id, repo['id'])
+
+            metrics.count('refresh.new_files', len(new_files))
+            metrics.count('refresh.changed_files', len(changed_files))
+            metrics.count('refresh.deleted_files', len(deleted_ids))
+
+        try:
+            with metrics.stage('store'):
+                writer.flush()
+        except psycopg2.DatabaseError, e:
+            logger.error('Error %s when storing refreshed license files' % e)
+            writer.db_conn.close()
+            sys.exit(1)
+
+        remember_shas(writer)
+        metrics.count('refresh.repos', len(repos))
+
+        logger.info("Refreshed %s repositories" % len(repos))
+        log_cache_stats()
+
+    if failed:
+        logger.error("Could not check %s repositories; they'll be tried "\
+                     "first next time" % len(failed))
+
+def replay(writer, start_id=None, end_id=None, concurrency=1):
+    # Store the archived /repositories pages with ids in (start_id, end_id]
+    # exactly as a crawl would, with api_request answering from the
+    # archive. The crawl cursor is left alone. Returns the number of
+    # requests the archive couldn't answer.
+    for repos_json, next_url, done in \
+            replay_archive.list_pages(start_id, end_id):
+        if repos_json:
+            process_page(writer, repos_json, None, concurrency,
+                         cursor_name=None)
+
+    counters = metrics.snapshot()['counters']
+    missing = counters.get('replay.missing', 0)
+
+    logger.info("Replayed %s requests" % counters.get('replay.requests', 0))
+
+    if missing:
+        logger.error("%s requests weren't in the archive; the repos that "\
+                     "needed them were marked failed" % missing)
+
+    return missing
         
 
 if __name__ == "__main__":
@@ -120,7 +962,7 @@ if __name__ == "__main__":
                            user=config['database_user'],
                            password=config['database_password'])    
     
-    cur = db_conn.cursor()
+    writer = db_writer.PageWriter(db_conn)
 
     # Set up the command line argument parser
     parser = optparse.OptionParser()
@@ -130,129 +972,211 @@ if __name__ == "__main__":
                       help="""URL to begin retriving repositories with
                               ('next' link from last result)""",
                       default="")
+
+    parser.add_option('-r', '--resume',
+                      action="store_true", dest="resume",
+                      help="""Continue from where the last crawl stopped
+                              and retry repos whose license files
+                              couldn't be fetched""",
+                      default=False)
+
+    parser.add_option('-c', '--concurrency',
+                      action="store", dest="concurrency", type="int",
+                      help="""Number of repos to fetch license files for
+                              in parallel""",
+                      default=1)
+
+    parser.add_option('-d', '--discovery',
+                      action="store", dest="discovery",
+                      type="choice", choices=['contents', 'graphql'],
+                      help="""How to find license files: 'contents' (REST,
+                              2 + N requests per repo) or 'graphql' (one
+                              query per batch of repos; needs a token)""",
+                      default='contents')
+
+    parser.add_option('--prefetch',
+                      action="store", dest="prefetch", type="int",
+                      help="""Number of pages of repos to list ahead of the
+                              one being stored (0 to list them in turn)""",
+                      default=2)
+
+    parser.add_option('--cache_dir',
+                      action="store", dest="cache_dir",
+                      help="""Directory to cache API responses in for
+                              conditional requests""",
+                      default=config.get('cache_directory') or "")
+
+    parser.add_option('--stats_file',
+                      action="store", dest="stats_file",
+                      help="""File to write counters and latency histograms
+                              to every minute""",
+                      default="output_stats.json")
+
+    parser.add_option('--profile',
+                      action="store_true", dest="profile",
+                      help="""Dump cProfile data for each stage into the
+                              'profile' directory""",
+                      default=False)
+
+    parser.add_option('--make_shards',
+                      action="store", dest="make_shards",
+                      help="""START:END:SIZE - split repository ids START
+                              to END into shards of SIZE ids for --shards
+                              workers and exit""",
+                      default="")
+
+    parser.add_option('--shards',
+                      action="store_true", dest="shards",
+                      help="""Claim and crawl shards made with --make_shards
+                              instead of crawling from a single cursor; run
+                              as many of these as you like""",
+                      default=False)
+
+    parser.add_option('--refresh',
+                      action="store_true", dest="refresh",
+                      help="""Re-check stored repos, least recently checked
+                              first, fetching only license files whose
+                              SHA changed and marking deleted ones (one
+                              request per unchanged repo)""",
+                      default=False)
+
+    parser.add_option('--allow_split_database',
+                      action="store_true", dest="allow_split_database",
+                      help="""Let --refresh run when static_database isn't
+                              database; license_id.py won't see the files
+                              it queues until they're copied over""",
+                      default=False)
+
+    parser.add_option('--archive_dir',
+                      action="store", dest="archive_dir",
+                      help="""Directory to append every API response to,
+                              for --replay""",
+                      default=config.get('archive_directory') or "")
+
+    parser.add_option('--replay',
+                      action="store", dest="replay",
+                      help="""Rebuild the database from the responses
+                              archived in this directory instead of calling
+                              the API; use the same --discovery as the
+                              crawl that recorded them""",
+                      default="")
+
+    parser.add_option('--replay_range',
+                      action="store", dest="replay_range",
+                      help="""START:END - only replay repositories with ids
+                              after START up to END (either may be left
+                              empty)""",
+                      default="")
     
     options, args = parser.parse_args()
 
+    # --refresh invalidates results in the crawler's database
+    if options.refresh and not options.allow_split_database and \
+            config.get('static_database') and \
+            config['static_database'] != config['database']:
+        parser.error("--refresh queues changed files for analysis in %s, "\
+                     "but license_id.py reads %s (use "\
+                     "--allow_split_database to run anyway)" % \
+                         (config['database'], config['static_database']))
+
     # Initialize log file
     logger = logging.getLogger(__name__)
     logging.basicConfig(filename='output.log',level=logging.ERROR)
     logging.getLogger(__name__).setLevel(logging.DEBUG)
 
-    # Get the URL from the 'url' argument or start from square one
-    repos_url = options.url or "https://api.github.com/repositories"
-    next_repos_url = repos_url
+    if options.stats_file:
+        metrics.start_flusher(options.stats_file)
 
-    # Make sure we haven't hit the rate limit
-    wait_for_rate_limit_reset()
+    if options.profile:
+        metrics.enable_profiling('profile')
 
-    # Retrieve pages of repos till rate limit is reached
-    r = api_request(next_repos_url)
+    discovery = options.discovery
+    api_url = config.get('api_url') or api_url
 
-    if requests_left < 10 or r.status_code != 200:
-        wait_for_rate_limit_reset()
+    if options.make_shards:
+        start_id, end_id, shard_size = [int(n) for n in
+                                        options.make_shards.split(':')]
+        created = shards.create_shards(db_conn, start_id, end_id, shard_size)
+        print('Created %s shards' % created)
+        sys.exit(0)
 
-    logger.info("Request status: %s" % r.headers['status'])
+    if options.replay:
+        start_id, end_id = [int(n) if n else None for n in
+                            (options.replay_range or ':').split(':')]
 
-    while(r.ok or r.status_code == 401):
-        repos_json = json.loads(r.text or r.content)
+        replay_archive = archive.ArchiveReader(options.replay)
+        known_shas = writer.get_known_shas()
 
-        logger.info("Requests left: %s" % requests_left)
+        missing = replay(writer, start_id, end_id, options.concurrency)
 
-        # Get link for next page of repos
-        links = link_header.parse_link_value(r.headers['link'])
+        if missing:
+            print("%s requests weren't in the archive; see the log for "\
+                  "which. Their repos were marked failed." % missing)
+            sys.exit(1)
 
-        for link_url in links:
-            if(links[link_url]['rel'] == 'next'):
-                next_repos_url = link_url
+        sys.exit(0)
 
-        # Process this page of repos
-        for repo in repos_json:
+    # Set up the credentials, the pooled HTTP session and the response cache
+    scheduler = credentials.CredentialScheduler(
+        credentials.load_credentials(config))
+    init_session(max(10, options.concurrency))
 
-            if requests_left < 10 or r.status_code != 200:
-                wait_for_rate_limit_reset()
+    if options.cache_dir:
+        cache_path = options.cache_dir
 
-            # Log the effort to store this repo's information:
-            logger.info("Storing repository #%s: %s (Fork? %s)" % \
-                            (repo['id'], repo['full_name'], repo['fork']))
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
 
-            #Some repos don't have owners
-            try:
-                owner = repo['owner']['login']
-            except TypeError:
-                owner = ""
+    if options.archive_dir:
+        try:
+            archive_writer = archive.ArchiveWriter(options.archive_dir)
+        except archive.ArchiveLocked, e:
+            logger.error(e)
+            sys.exit(1)
 
-            # Store repo in the DB
-            try:
-                cur.execute("""
-                            INSERT INTO repositories(gh_id, owner_login, name,
-                                        full_name, description, private, fork,
-                                        api_url, html_url) VALUES (%s, %s, %s, 
-                                        %s, %s, %s, %s, %s, %s)
-                            """, (repo['id'], owner,
-                                  repo['name'], repo['full_name'],
-                                  repo['description'], repo['private'], 
-                                  repo['fork'], repo['url'],
-                                  repo['html_url']))
-
-                db_conn.commit()
-
-                # Find likely license files
-                licenses = get_repo_licenses(repo['url'])
-                license_names = []
-
-                for license_name in licenses:
-                    license_names.append(license_name)
-                    alicense = licenses[license_name]
-
-                    logger.info("Storing license: %s" % license_name)
-
-                    # Store this license in the DB
-                    try:
-                        cur.execute("""
-                            INSERT INTO repository_licenses(repository_id,
-                                        type, encoding, api_url, html_url,
-                                        size, name, path, content, sha) VALUES (
-                                        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                            """, (repo['id'], alicense['type'], 
-                                  alicense['encoding'], 
-                                  alicense['_links']['self'],
-                                  alicense['_links']['html'],
-                                  alicense['size'], alicense['name'],
-                                  alicense['path'], alicense['content'], 
-                                  alicense['sha']))
-
-                        db_conn.commit()
-                    except psycopg2.DatabaseError, e:
-                        db_conn.rollback()
-    
-                        logger.error('Error %s when adding file %s for repo %s' %\
-                                         (e, license_name, repo['full_name']))    
-                        db_conn.close()
-                        sys.exit(1)
+    # Get the URL from the 'url' argument or start from square one
+    repos_url = options.url or "%s/repositories" % api_url
 
-            except psycopg2.IntegrityError:
+    # Make sure we haven't hit the rate limit
+    wait_for_rate_limit_reset()
 
-                # We've already got one -- rollback and hit the next one
-                logger.info("Repository already retrieved, moving on...")
-                db_conn.rollback()
+    known_shas = writer.get_known_shas()
+    logger.info("%s distinct license blobs already stored" % len(known_shas))
 
-            except psycopg2.DatabaseError, e:
+    # Pick up the stored cursor and retry earlier failures
+    if options.resume:
+        cursor = writer.get_cursor('repositories')
 
-                # Unhandled errors dump us 
-                db_conn.rollback()
-    
-                logger.error('Error %s when inserting %s' % (e, repo['full_name']))    
-                db_conn.close()
-                sys.exit(1)
+        if cursor and not options.url:
+            repos_url = cursor[0]
+            logger.info("Resuming after repository #%s from %s" % \
+                            (cursor[1], repos_url))
 
-        # Get the next page of repos
-        logger.info("Finished a page. Getting the next from %s" %\
-            next_repos_url)
+        retry_failed_repos(writer, options.concurrency)
 
-        r = api_request(next_repos_url)
-        logger.info("Request status: %s" % r.headers['status'])
+    if options.refresh:
+        refresh_repos(writer, options.concurrency)
+        sys.exit(0)
 
-        while r.status_code == 401:
-            logger.info("Got a 401. Retrying...")
-            time.sleep(60)
-            r = api_request(next_repos_url)
+    if options.shards:
+        run_shard_worker(writer, options.concurrency, options.prefetch)
+        sys.exit(0)
+
+    # List pages ahead of the one being stored, till we run out of repos
+    try:
+        for repos_json, next_repos_url, done in \
+                prefetch(list_pages(repos_url), options.prefetch):
+            logger.info("Requests left: %s" % requests_left)
+
+            # Process this page of repos
+            process_page(writer, repos_json, next_repos_url,
+                         options.concurrency)
+
+            log_cache_stats()
+
+            logger.info("Finished a page. The next is at %s" % \
+                next_repos_url)
+    except ListingError, e:
+        logger.error(e)
+        writer.db_conn.close()
+        sys.exit(1)
@@ -4,21 +4,59 @@ import yaml
 import re
 import logging
 import psycopg2
+import psycopg2.extras
 import sys
 import os
 import hashlib
 import optparse
 import subprocess
-import csv
 import shutil
+import itertools
+import multiprocessing
+import canonical
+import readme
+import rules
+import blobs
+import db_writer
+import schema
+import metrics
+import threading
+import signal
 from base64 import b64decode
 
 config = None
 db_conn = None
 cur = None
-nomos_re = re.compile(r"[^\)]*\)\s(.*)")
+scratch_path = None
+stats_file = None
 
-def process_licenses(start = 0):
+# Set in pool worker processes, which write their stats to their own file
+in_worker = False
+worker_stats_file = None
+
+# Which classifier process_licenses uses: 'nomos' or 'fingerprint'
+engine = 'nomos'
+classifier = None
+
+# Normalized text hash -> abbreviations, for the exact-match fast path:
+# the reference texts, and what the scanner found for recent texts
+canonical_table = {}
+learned_hashes = canonical.LearnedHashes()
+
+# (engine, engine version) stamped on each result in license_scans, so
+# files can be rescanned when the scanner changes. Fast path results get
+# stamps of their own (see fast_path_stamps).
+scan_stamp = None
+
+# Normalization of raw scanner output and mapping to the licenses table.
+# Stored results are re-normalized by --reanalyze_stale without a rescan
+# when RULES_VERSION changes.
+rule_engine = rules.RuleEngine()
+RULES_VERSION = rules.VERSION
+nomos_file_re = re.compile(r"File (.*) contains license\(s\) (.*)")
+
+def process_licenses(start = 0, workers = 1, batch_size = 50,
+                     page_size = 1000, stale_only = False):
 
     # Create a directory to store the license files in
     base_path = config['export_directory']
@@ -26,235 +64,833 @@ def process_licenses(start = 0):
     if not os.path.exists(base_path):
         os.makedirs(base_path)
 
-    # Get repo count
-    cur.execute("""SELECT COUNT(*) FROM repositories""")
+    stamp = get_scan_stamp()
+    canonical_stamp, learned_stamp = fast_path_stamps()
+
+    # With stale_only, skip files with results from the current engine
+    # version or fast path
+    stale_clause = ""
+    stale_args = ()
+
+    if stale_only:
+        stale_clause = """
+                      AND NOT EXISTS (SELECT 1 FROM license_scans s
+                                       WHERE s.license_id = l.id
+                                         AND (s.engine, s.engine_version)
+                                             IN %s)"""
+        stale_args = (current_stamps(),)
+
+    # Count the license files we're going to look at
+    cur.execute("""SELECT COUNT(*)
+                     FROM repositories r
+                     JOIN repository_licenses l
+                       ON r.gh_id = l.repository_id
+                    WHERE r.fork = 'f'
+                      AND l.deleted_at IS NULL
+                      AND r.id >= %s""" + stale_clause,
+                (start,) + stale_args)
     count = cur.fetchone()[0]
+    processed = 0
 
-    logger.info("There are %s repositories. Processing..." % count)
+    logger.info("There are %s license files in non-fork repositories to "\
+                "scan with %s %s. Processing..." % ((count,) + stamp))
 
-    end = start + 999
+    # Page through the files in (r.id, l.id) order, picking up after the
+    # last row of the previous page, so gaps in the ids cost nothing
+    last_key = (start, -1)
 
-    while start < count:
+    # Spread the nomos scans over a pool of processes, each with its own
+    # scratch directory; results come back in order to this process,
+    # which does all the DB writes
+    pool = None
 
-        logger.info("Processing repositories %s - %s..." % (start, end))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_scan_worker,
+                                    (base_path, True))
+    else:
+        init_scan_worker(base_path)
 
-	if not os.path.exists(base_path):
-            os.makedirs(base_path)
+    while True:
+
+        logger.info("Processing license files after repository %s..." % \
+            last_key[0])
 
         # Get license info
-        cur.execute("""SELECT r.id, r.full_name, l.content, l.name, l.id
-                   FROM repositories r, repository_licenses l
-                   WHERE r.gh_id = l.repository_id
-	 	     AND r.fork = 'f'
-                     AND r.id >=%s AND r.id <= %s
-                """ % (start, end))
-
-        licenses = cur.fetchall()
-	last_repo_path = None       
- 
-	for row in licenses:
+        with metrics.stage('select'):
+            with metrics.timer('db.select_licenses'):
+                cur.execute("""SELECT r.id, r.full_name, l.content, l.name,
+                                      l.id, l.sha
+                                 FROM repositories r
+                                 JOIN repository_licenses l
+                                   ON r.gh_id = l.repository_id
+                                WHERE r.fork = 'f'
+                                  AND l.deleted_at IS NULL
+                                  AND (r.id, l.id) > (%s, %s)""" + \
+                            stale_clause + """
+                             ORDER BY r.id, l.id
+                                LIMIT %s""",
+                            (last_key[0], last_key[1]) + stale_args + \
+                            (page_size,))
+
+                licenses = cur.fetchall()
+
+        if not licenses:
+            break
+
+        last_key = (licenses[-1][0], licenses[-1][4])
+
+        # Work out which blobs need scanning
+        jobs = []
+        queued = set()
+        reused = 0
+        scan_results = {}
+        job_hashes = {}
+        exact_hits = 0
+        unscanned = []
+        readme_bytes = [0, 0]
+
+        # Identical files share a git SHA, so each distinct blob only
+        # needs to go through nomos once. Blobs scanned on earlier pages
+        # or runs are found in license_scans. Results are kept as (raw
+        # licenses, stamp) pairs, so reused ones keep the stamp of
+        # whatever produced them.
+        with metrics.timer('db.select_sha_results'):
+            sha_results = get_sha_results([row[5] for row in licenses
+                                           if row[5]])
+
+        for row in licenses:
+            key = scan_key(row)
+
+            if key in queued:
+                continue
+
+            if row[5] in sha_results:
+                reused = reused + 1
+                continue
+
+            unscanned.append(row)
+            queued.add(key)
+
+        # Fetch the bodies of those blobs in one query
+        with metrics.timer('db.select_blobs'):
+            blob_texts = get_blob_contents([row[5] for row in unscanned
+                                            if row[5]])
+
+        for row in unscanned:
+            license_name = row[3]
+            key = scan_key(row)
+
+            # Files without a sha keep their base64 content inline
+            content = blob_texts.get(row[5])
+
+            if content is None:
+                content = blobs.file_text(None, row[2])
+
+            if content is None:
+                logger.error("No content stored for blob %s (%s/%s)" % \
+                    (row[5], row[1], license_name))
+                queued.discard(key)
+                continue
+
+            # Empty files have no license, whatever the engine
+            if not content:
+                scan_results[key] = ([rules.NO_LICENSE], stamp)
+                metrics.count('analysis.empty_files')
+
+                if key[0] == 'sha':
+                    sha_results[key[1]] = scan_results[key]
+
+                continue
+
+            # Verbatim copies of the reference texts, or of texts the
+            # scanner has seen recently, don't need a scanner
+            normalized_hash = canonical.text_hash(content)
+            known = canonical_table.get(normalized_hash)
+            known_stamp = canonical_stamp
+
+            if known is None:
+                known = learned_hashes.get(normalized_hash)
+                known_stamp = learned_stamp
+
+            if known is not None:
+                scan_results[key] = (known, known_stamp)
+                exact_hits = exact_hits + 1
+
+                if key[0] == 'sha':
+                    sha_results[key[1]] = scan_results[key]
+
+                continue
+
+            job_hashes[key] = normalized_hash
+
+            # Only the license parts of READMEs go to the scanner
+            if readme.is_readme(license_name):
+                scan_text = readme.scan_text(license_name, content)
+                readme_bytes[0] = readme_bytes[0] + len(scan_text)
+                readme_bytes[1] = readme_bytes[1] + \
+                    len(content) - len(scan_text)
+
+                metrics.count('readme.files')
+                if scan_text is content:
+                    metrics.count('readme.full_scans')
+
+                content = scan_text
+
+            jobs.append((key, license_name, content))
+
+        logger.info("Exact-match fast path: %s hits, %s misses "\
+                    "(%.1f%% hit rate)" % (exact_hits, len(jobs),
+                    100.0 * exact_hits / max(exact_hits + len(jobs), 1)))
+
+        if readme_bytes[0] or readme_bytes[1]:
+            metrics.count('readme.bytes_scanned', readme_bytes[0])
+            metrics.count('readme.bytes_skipped', readme_bytes[1])
+
+            logger.info("READMEs: scanning %s bytes, skipped %s (%.1f%%)" % \
+                (readme_bytes[0], readme_bytes[1],
+                 100.0 * readme_bytes[1] / sum(readme_bytes)))
+
+        batches = [jobs[i:i + batch_size]
+                   for i in range(0, len(jobs), batch_size)]
+
+        if pool:
+            scans = pool.imap(scan_licenses, batches)
+        else:
+            scans = itertools.imap(scan_licenses, batches)
+
+        for row in licenses:
             repo_id = row[0]
             repo_name = row[1]
-            license_text = b64decode(row[2])
             license_name = row[3]
             license_id = row[4]
+            key = scan_key(row)
 
-            repo_path = os.path.join(base_path, repo_name)
-	
-	    if last_repo_path != None and last_repo_path != repo_path:
-	    	shutil.rmtree(last_repo_path)
+            logger.info("Processing %s/%s (%s)..." % \
+                (repo_name, license_name, repo_id,))
 
-	    last_repo_path = repo_path
+            if row[5] in sha_results:
+                licenses_found, result_stamp = sha_results[row[5]]
+            elif key in scan_results:
+                licenses_found, result_stamp = scan_results[key]
+            elif key in queued:
+                # Wait for this row's scan, keeping any that finish first
+                while key not in scan_results:
+                    with metrics.timer('analysis.scan_wait'):
+                        batch_results = scans.next()
+
+                    for done_key, done_licenses in batch_results:
+                        scan_results[done_key] = (done_licenses, stamp)
+
+                        if done_key[0] == 'sha':
+                            sha_results[done_key[1]] = scan_results[done_key]
+
+                        # Later copies of the same normalized text can
+                        # skip the scanner too
+                        if done_key in job_hashes:
+                            learned_hashes.add(job_hashes[done_key],
+                                               done_licenses)
+
+                licenses_found, result_stamp = scan_results[key]
+            else:
+                continue
+
+            # Replace the file's DB entries with the licenses found
+            try:
+                with metrics.stage('store'):
+                    licenses_found = store_results(license_id,
+                                                   licenses_found,
+                                                   stamp = result_stamp)
+            except psycopg2.DatabaseError, e:
+                db_conn.rollback()
+
+                logger.error('Error %s when updating metadata for %s/%s' %\
+                                 (e, repo_name, license_name))
+                db_conn.close()
+                sys.exit(1)
 
-            license_path = os.path.join(repo_path, license_name)
+            logger.info("%s/%s (%s) contains: %s" % \
+                (repo_name, license_name, repo_id, ", ".join(licenses_found)))
 
-	    logger.info("Processing %s/%s (%s)..." % \
-                (repo_name, license_name, repo_id,))
+        processed = processed + len(licenses)
+
+        logger.info("Scanned %s files, reused results for %s" % \
+            (len(jobs), reused))
+        logger.info("Processed %s of %s license files (%.1f%%)" % \
+            (processed, count, 100.0 * processed / max(count, 1)))
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    shutil.rmtree(base_path)
+
+
+def store_results(license_id, raw_licenses, commit = True,
+                  licenses_found = None, stamp = None):
+    # Normalize a file's raw scan results (unless that's been done) and
+    # bring its license_metadata rows in line with them, stamped with the
+    # rules version and `stamp` (by default the engine's), in one
+    # transaction. Only rows that differ are touched, and the file only
+    # gets a new change_id (which export.py --incremental follows) if any
+    # did. If the file lost a license, its repo's mappings are dropped
+    # for -a to redo. Returns the normalized licenses.
+    if licenses_found is None:
+        licenses_found = rule_engine.normalize(raw_licenses)
+
+    licenses_found = list(licenses_found)
+
+    with metrics.timer('db.metadata_insert'):
+        schema.lock_changes(cur)
+
+        cur.execute("""DELETE FROM license_metadata
+                        WHERE license_id = %s
+                          AND NOT license_abbr = ANY(%s::varchar[])""",
+                    (license_id, licenses_found))
+        changed = cur.rowcount
+
+        # The repo may not have that license any more
+        if changed:
+            cur.execute("""SELECT repository_id FROM repository_licenses
+                            WHERE id = %s""", (license_id,))
+            db_writer.unmap_repos(cur, [row[0] for row in cur.fetchall()])
+
+        cur.execute("""INSERT INTO license_metadata(license_id, license_abbr)
+                       SELECT %s, abbr
+                         FROM unnest(%s::varchar[]) AS abbr
+                  ON CONFLICT (license_id, license_abbr) DO NOTHING""",
+                    (license_id, licenses_found))
+        changed = changed + cur.rowcount
+
+        cur.execute("""
+            INSERT INTO license_scans(license_id, engine, engine_version,
+                        rules_version, raw_licenses)
+                 VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (license_id) DO UPDATE
+                    SET engine = EXCLUDED.engine,
+                        engine_version = EXCLUDED.engine_version,
+                        rules_version = EXCLUDED.rules_version,
+                        raw_licenses = EXCLUDED.raw_licenses,
+                        scanned_at = now(),
+                        change_id = CASE WHEN %s
+                                         THEN nextval('license_scan_changes')
+                                         ELSE license_scans.change_id END
+            """, (license_id,) + (stamp or get_scan_stamp()) + \
+                     (RULES_VERSION, list(raw_licenses), changed > 0))
+
+    if commit:
+        with metrics.timer('db.commit'):
+            db_conn.commit()
 
-            if not os.path.exists(repo_path):
-                os.makedirs(repo_path)
+    return licenses_found
+
+
+def renormalize_stale(page_size = 1000):
+    # Files the current engine or fast path matched under older
+    # normalization rules only need their stored raw results run through
+    # the rules again
+    last_id = -1
+    renormalized = 0
+
+    while True:
+        cur.execute("""SELECT s.license_id, s.raw_licenses, s.engine,
+                              s.engine_version
+                         FROM license_scans s
+                         JOIN repository_licenses l
+                           ON l.id = s.license_id
+                        WHERE (s.engine, s.engine_version) IN %s
+                          AND s.rules_version <> %s
+                          AND s.license_id > %s
+                          AND l.deleted_at IS NULL
+                     ORDER BY s.license_id
+                        LIMIT %s""",
+                    (current_stamps(), RULES_VERSION, last_id, page_size))
+        rows = cur.fetchall()
+
+        if not rows:
+            break
+
+        last_id = rows[-1][0]
+        normalized = rule_engine.normalize_batch([row[1] for row in rows])
 
-            if not os.path.exists(license_path):
-                f = open(license_path, 'w')
-                f.write(license_text)
-                f.close()
+        try:
+            for row, licenses_found in zip(rows, normalized):
+                license_id = row[0]
+                store_results(license_id, row[1], commit = False,
+                              licenses_found = licenses_found,
+                              stamp = (row[2], row[3]))
 
-            licenses_found = process_nomos_output(license_path)
-            logger.info("%s/%s (%s) contains: %s" % \
-                (repo_name, license_name, repo_id, ", ".join(licenses_found)))
+            db_conn.commit()
+        except psycopg2.DatabaseError, e:
+            db_conn.rollback()
 
-	    os.remove(license_path)
-
-            # Create a DB entry for each license found
-            for abbr in licenses_found:
-                try:
-                    cur.execute("""
-                            INSERT INTO license_metadata(license_id,
-                                        license_abbr)
-                                        VALUES ( %s, %s )
-                            """, (license_id, abbr))
-
-                    db_conn.commit()
-                except psycopg2.IntegrityError, e:
-                    db_conn.rollback()
-                    logger.error('Integrity Error %s. Metadata record may '\
-                                 'already exist for this project+license.' %\
-                                 e)    
-                except psycopg2.DatabaseError, e:
-                    db_conn.rollback()
-                
-                    logger.error('Error %s when updating metadata for %s' %\
-                                     (e, abbr))    
-                    db_conn.close()
-                    sys.exit(1)
-
-        start = start + 1000
-        end = end + 1000
-
-        shutil.rmtree(base_path)
+            logger.error('Error %s when re-normalizing license files '\
+                         'after %s' % (e, license_id))
+            db_conn.close()
+            sys.exit(1)
 
+        renormalized = renormalized + len(rows)
+        logger.info("Re-normalized %s license files under rules "\
+                    "version %s" % (renormalized, RULES_VERSION))
 
-def process_nomos_output(license_path):
+    return renormalized
 
-    nomos_path = config['nomos_path']
-    exe = [nomos_path, license_path]
 
-    for line in runProcess(exe):
-        output = line.strip()
+def get_scan_stamp():
+    # The README extractor's version is part of every file's stamp, as
+    # results are shared between files by SHA whatever they're called
+    global scan_stamp
 
-        if len(line.split()):
-            m = nomos_re.match(output)
+    if scan_stamp is None:
+        if engine == 'fingerprint':
+            version = classifier.version
+        else:
+            version = nomos_version()
 
-            if m:
-                licenses_found = m.group(1).split(',')
-                licenses_found = sanitize_license_list(licenses_found)
-            else:
-                licenses_found = []
+        scan_stamp = (engine, "%s readme-%s" % (version, readme.VERSION))
 
-            return licenses_found
+    return scan_stamp
 
 
-def sanitize_license_list(license_list):
+def fast_path_stamps():
+    # Stamps for results that didn't come from running the scanner on
+    # the file: matches against the canonical table, which are current
+    # as long as the table is, and copies of what the current engine
+    # found in the same normalized text
+    engine_name, engine_version = get_scan_stamp()
 
-    # Find all the licenses we want to filter for
-    ruby_i = list_search(license_list, "Ruby")
-    pd_i = list_search(license_list, "Public-domain")
-    mit_i = list_search(license_list, "MIT")
-    mit_style_i = list_search(license_list, "MIT-style")
-    artistic_i = list_search(license_list, "Artistic")
-    fsf_i = list_search(license_list, "FSF")
-    gpl_i = list_substring_search(license_list, "GPL")
-    agpl_i = list_substring_search(license_list, "Affero")
+    return (('canonical', canonical.table_version(canonical_table)),
+            ('%s-learned' % engine_name, engine_version))
 
-    # All "MIT" and "MIT-style" should just be "MIT"
-    if mit_i > -1 and mit_style_i > -1:
-        license_list.remove("MIT-style")
-    elif mit_style_i > -1:
-        license_list[mit_style_i] = "MIT"
 
-    # "Public domain" match for Ruby, Artistic & GPL(s) are usually
-    # false positives
-    if pd_i > -1 and (agpl_i > -1 or gpl_i > -1 \
-                      or ruby_i > -1 or artistic_i > -1):
-        license_list.remove("Public-domain")
+def current_stamps():
+    # Every stamp a result can have and still be up to date
+    return (get_scan_stamp(),) + fast_path_stamps()
 
-    # "FSF" match for GPL not needed
-    if gpl_i > -1 and fsf_i > -1:
-        license_list.remove("FSF")
 
-    return license_list
+def nomos_version():
+    # config can pin the version for builds whose -V output isn't useful
+    if config.get('nomos_version'):
+        return str(config['nomos_version'])
 
+    output = [line.strip() for line in
+              runProcess([config['nomos_path'], '-V'], 60) if line.strip()]
 
-def list_search(alist, value):
-    try:
-        i = alist.index(value)
-    except:
-        i = -1
+    return output[0] if output else 'unknown'
 
-    return i
 
+def scan_key(row):
+    # Scans are shared by git SHA; rows without one get their own
+    if row[5]:
+        return ('sha', row[5])
 
-def list_substring_search(alist, search_substring):
-    for item in alist:
-        if re.search(search_substring, item):
-            return alist.index(item)
+    return ('license', row[4])
 
-    return -1
 
+def init_scan_worker(base_path, worker_process = False):
+    global scratch_path, in_worker, worker_stats_file
 
-def runProcess(exe):    
+    scratch_path = os.path.join(base_path, "worker-%s" % os.getpid())
 
-    p = subprocess.Popen(exe, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if not os.path.exists(scratch_path):
+        os.makedirs(scratch_path)
 
-    while(True):
-      retcode = p.poll() #returns None while subprocess is running
-      line = p.stdout.readline()
-      yield line
-      if(retcode is not None):
-        break
+    # Pool workers keep their own stats (forking copied the parent's)
+    if worker_process:
+        metrics.reset()
+        in_worker = True
 
+        if stats_file:
+            worker_stats_file = "%s.%s" % (stats_file, os.getpid())
 
-def map_repos_to_licenses(start = 0):
-    # Iterate through each repo's licenses, mapping each to an entry
-    # in the master abbreviation list, dropping duplicate & equivalent
-    # entries
 
-    cur.execute("""SELECT id, license_abbr FROM licenses""")
-    abbrs = cur.fetchall()
-    lic_map = {}
+def scan_licenses(jobs):
+    # The stage is marked here so --profile sees the scan itself, in
+    # whichever process runs it, rather than the wait for its result
+    with metrics.stage('scan'):
+        if engine == 'fingerprint':
+            results = scan_with_fingerprint(jobs)
+        else:
+            results = scan_with_nomos(jobs)
 
-    # Create a dict mapping license names to IDs
-    for row in abbrs:
-        lic_map[row[1]] = row[0]
+    # Pool workers are stopped without running atexit handlers, so they
+    # write their stats and profiles out after every batch
+    if in_worker:
+        if worker_stats_file:
+            metrics.write_stats(worker_stats_file)
+        if metrics.profile_path:
+            metrics.dump_profiles()
 
-    cur.execute("""SELECT r.id as rid, l.id as lid, m.license_abbr as abbr
-                     FROM repositories r
-                     JOIN repository_licenses l 
-                       ON r.gh_id = l.repository_id 
-                     JOIN license_metadata m
-                       ON l.id = m.license_id
-                    WHERE m.license_abbr != 'No_license_found'
-                      AND r.id > %s
-                 ORDER BY r.id, l.id
-                   """ % start) 
+    return results
+
+
+def scan_with_fingerprint(jobs):
+    # Classify a batch of license files in-process
+    results = []
+
+    for job in jobs:
+        with metrics.timer('fingerprint.classify'):
+            results.append((job[0], fingerprint_licenses(job[2])))
+
+    metrics.count('fingerprint.files', len(jobs))
+
+    return results
+
+
+def fingerprint_licenses(license_text):
+    licenses_found = classifier.classify(license_text.decode('utf-8',
+                                                             'replace'))
+
+    if not licenses_found:
+        return ['No_license_found']
+
+    return licenses_found
+
+
+def scan_with_nomos(jobs):
+    # Write a batch of license files to this worker's scratch directory
+    # and run them through a single nomos process. Files get numbered
+    # names so nomos' output can be matched back to them.
+    license_paths = []
+
+    for i, job in enumerate(jobs):
+        key, license_name, license_text = job
+        license_path = os.path.join(scratch_path, "%04d_%s" % \
+                                        (i, license_name.replace(' ', '_')))
+
+        with metrics.timer('analysis.write'):
+            f = open(license_path, 'w')
+            f.write(license_text)
+            f.close()
+
+        license_paths.append(license_path)
 
-    licenses = cur.fetchall()
+    found = process_nomos_batch(license_paths)
 
-    variant_re = re.compile(r"(.*)\-(style|possibility)")
+    for license_path in license_paths:
+        os.remove(license_path)
 
-    for alicense in licenses:
-        r_id = alicense[0]
-        l_id = alicense[1]
-        l_abbr = alicense[2]
+    return [(job[0], found[license_path])
+            for job, license_path in zip(jobs, license_paths)]
 
-        variant = variant_re.match(l_abbr)
-        license_id = None
 
-        if variant and lic_map.has_key(variant.group(1)):
-            license_id = lic_map[variant.group(1)]
+def get_sha_results(shas):
+    # sha -> (raw licenses, stamp) for each of the given blobs with up to
+    # date results, in one query
+    if not shas:
+        return {}
+
+    cur.execute("""SELECT DISTINCT ON (l.sha) l.sha, s.raw_licenses,
+                          s.engine, s.engine_version
+                     FROM license_scans s
+                     JOIN repository_licenses l
+                       ON l.id = s.license_id
+                    WHERE l.sha = ANY(%s)
+                      AND (s.engine, s.engine_version) IN %s""",
+                (list(set(shas)), current_stamps()))
+
+    return dict([(row[0], (row[1], (row[2], row[3])))
+                 for row in cur.fetchall()])
+
+
+def get_blob_contents(shas):
+    # sha -> raw file bytes for the given blobs, from license_blobs or,
+    # if they haven't been migrated yet, repository_licenses.content
+    if not shas:
+        return {}
+
+    cur.execute("""SELECT sha, content FROM license_blobs
+                    WHERE sha = ANY(%s)""", (shas,))
+    texts = dict([(row[0], blobs.decompress(row[1]))
+                  for row in cur.fetchall()])
+
+    missing = [sha for sha in shas if not sha in texts]
+
+    if missing:
+        cur.execute("""SELECT DISTINCT ON (sha) sha, content
+                         FROM repository_licenses
+                        WHERE sha = ANY(%s) AND content IS NOT NULL""",
+                    (missing,))
+
+        for row in cur.fetchall():
+            texts[row[0]] = b64decode(row[1])
+
+    return texts
+
+
+def process_nomos_output(license_path):
+    return process_nomos_batch([license_path])[license_path]
+
+
+def process_nomos_batch(license_paths):
+    # Scan many files with one nomos process and return the (raw)
+    # licenses found in each. If nomos hangs it's killed; the first file
+    # without a result is given up on and the rest are scanned again.
+    nomos_path = config['nomos_path']
+    timeout = config.get('nomos_timeout') or 300
+    found = {}
+    remaining = list(license_paths)
+
+    while remaining:
+        by_name = dict([(os.path.basename(path), path) for path in remaining])
+        timed_out = []
+
+        metrics.count('nomos.invocations')
+        metrics.count('nomos.files', len(remaining))
+
+        with metrics.timer('nomos.invocation'):
+            for line in runProcess([nomos_path] + remaining, timeout,
+                                   timed_out):
+                m = nomos_file_re.match(line.strip())
+
+                if m and m.group(1) in by_name:
+                    found[by_name[m.group(1)]] = m.group(2).split(',')
+
+        remaining = [path for path in remaining if not path in found]
+
+        if timed_out and remaining:
+            metrics.count('nomos.timeouts')
+            logger.error("nomos timed out after %ss scanning %s" % \
+                             (timeout, remaining[0]))
+            found[remaining.pop(0)] = []
         else:
-            license_id = lic_map[l_abbr]
+            break
+
+    # Anything nomos said nothing about
+    for path in remaining:
+        found[path] = []
+
+    return found
+
+
+def runProcess(exe, timeout=None, timed_out=None):
+    # Stream the process' output line by line. If it runs past the
+    # timeout it's killed and True is appended to timed_out.
+    # Run it in its own process group so a kill takes any children too
+    p = subprocess.Popen(exe, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         preexec_fn=os.setsid)
+    timer = None
+
+    def kill():
+        if timed_out is not None:
+            timed_out.append(True)
+
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+
+    try:
+        for line in iter(p.stdout.readline, ''):
+            yield line
+    finally:
+        if timer:
+            timer.cancel()
+        p.stdout.close()
+        p.wait()
+
+
+def map_repos_to_licenses(start = 0, chunk_size = 100000):
+    # Map each repo's licenses to entries in the master abbreviation
+    # list, one chunk of repository ids at a time. The rule engine works
+    # out what each distinct abbreviation maps to ("-style" and
+    # "-possibility" variants go to their base license when we know it)
+    # into a temporary table the inserts join against; duplicates &
+    # equivalent entries are dropped by the UNIQUE constraint. The new
+    # associations are added to license_repo_counts in the same
+    # statement.
+    try:
+        load_abbr_map()
+    except psycopg2.DatabaseError, e:
+        db_conn.rollback()
+
+        logger.error('Error %s when loading license abbreviations' % e)
+        db_conn.close()
+        sys.exit(1)
+
+    cur.execute("""SELECT MAX(id) FROM repositories""")
+    max_id = cur.fetchone()[0] or 0
+    unknown = {}
 
-        print('Associating repository %s with license %s' % (r_id, l_abbr))
+    while start < max_id:
+        end = start + chunk_size
 
         try:
             cur.execute("""
-                        INSERT INTO repository_license_abbr(repository_id, license_abbr_id)
-                             VALUES ( %s, %s )
-                        """, (r_id, license_id))
+                WITH new AS (
+                INSERT INTO repository_license_abbr(repository_id,
+                                                    license_abbr_id)
+                SELECT DISTINCT r.id, am.license_abbr_id
+                  FROM repositories r
+                  JOIN repository_licenses l
+                    ON r.gh_id = l.repository_id
+                  JOIN license_metadata m
+                    ON l.id = m.license_id
+                  JOIN abbr_map am
+                    ON am.license_abbr = m.license_abbr
+                 WHERE r.id > %s AND r.id <= %s
+                   AND am.license_abbr_id IS NOT NULL
+            ON CONFLICT DO NOTHING
+             RETURNING repository_id, license_abbr_id),
+
+                counted AS (
+                INSERT INTO license_repo_counts(license_abbr_id, repos,
+                                                fork_repos)
+                SELECT new.license_abbr_id, COUNT(*),
+                       COUNT(*) FILTER (WHERE r.fork)
+                  FROM new
+                  JOIN repositories r
+                    ON r.id = new.repository_id
+              GROUP BY new.license_abbr_id
+            ON CONFLICT (license_abbr_id) DO UPDATE
+                    SET repos = license_repo_counts.repos + EXCLUDED.repos,
+                        fork_repos = license_repo_counts.fork_repos +
+                                     EXCLUDED.fork_repos,
+                        updated_at = now())
+
+                SELECT COUNT(*) FROM new
+                """, (start, end))
+
+            mapped = cur.fetchone()[0]
+
+            # Collect the abbreviations missing from the licenses table
+            cur.execute("""
+                SELECT m.license_abbr, COUNT(*)
+                  FROM repositories r
+                  JOIN repository_licenses l
+                    ON r.gh_id = l.repository_id
+                  JOIN license_metadata m
+                    ON l.id = m.license_id
+                  JOIN abbr_map am
+                    ON am.license_abbr = m.license_abbr
+                 WHERE r.id > %s AND r.id <= %s
+                   AND am.license_abbr_id IS NULL
+              GROUP BY m.license_abbr
+                """, (start, end))
+
+            for abbr, abbr_count in cur.fetchall():
+                unknown[abbr] = unknown.get(abbr, 0) + abbr_count
 
             db_conn.commit()
-        except psycopg2.IntegrityError, e:
-            db_conn.rollback()
-            logger.error('Integrity Error %s. License %s already associated with repo %s.' %\
-                             (e, l_abbr, r_id))    
         except psycopg2.DatabaseError, e:
             db_conn.rollback()
-                
-            logger.error('Error %s when associating repo %s with license %s' %\
-                             (e, r_id, license_id))    
+
+            logger.error('Error %s when mapping repos %s - %s to licenses' %\
+                             (e, start + 1, end))
             db_conn.close()
-            sys.exit(1)        
+            sys.exit(1)
+
+        logger.info("Mapped repositories %s - %s: %s new associations" % \
+            (start + 1, end, mapped))
+
+        start = end
+
+    # Report abbreviations we couldn't map
+    for abbr in sorted(unknown, key=unknown.get, reverse=True):
+        logger.error("Unknown license abbreviation %s (%s files)" % \
+                         (abbr, unknown[abbr]))
+        print('Unknown license abbreviation %s (%s files)' % \
+                  (abbr, unknown[abbr]))
+
+
+def load_abbr_map():
+    # Fill the session's abbr_map table with the licenses id (or NULL)
+    # of every abbreviation in license_metadata
+    cur.execute("""SELECT license_abbr, id FROM licenses""")
+    rule_engine.set_license_ids(dict(cur.fetchall()))
+
+    cur.execute("""SELECT DISTINCT license_abbr FROM license_metadata""")
+    abbr_map = rule_engine.map_abbrs([row[0] for row in cur.fetchall()])
+
+    cur.execute("""DROP TABLE IF EXISTS abbr_map""")
+    cur.execute("""CREATE TEMP TABLE abbr_map(
+                                license_abbr VARCHAR PRIMARY KEY,
+                                license_abbr_id INT)""")
+
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO abbr_map(license_abbr, license_abbr_id) VALUES %s
+        """, abbr_map.items())
+
+    cur.execute("""ANALYZE abbr_map""")
+    db_conn.commit()
+
+    logger.info("%s of %s license abbreviations map to known licenses" % \
+        (len([i for i in abbr_map.values() if i is not None]), len(abbr_map)))
+
+
+def load_classifier():
+    global classifier
+    import fingerprint
+
+    classifier = fingerprint.FingerprintClassifier(
+        config['reference_licenses_directory'],
+        config.get('fingerprint_threshold') or 0.8)
+
+    logger.info("Loaded %s reference licenses" % len(classifier.abbrs))
+
+
+def cross_check_engines(sample_size, batch_size = 50):
+    # Run nomos and the fingerprint classifier over a random sample of
+    # license files and report how often they agree
+    base_path = config['export_directory']
+    init_scan_worker(base_path)
+
+    cur.execute("""SELECT l.id, l.name, b.content, l.content
+                     FROM repository_licenses l
+                LEFT JOIN license_blobs b
+                       ON b.sha = l.sha
+                    WHERE b.content IS NOT NULL
+                       OR l.content IS NOT NULL
+                 ORDER BY random()
+                    LIMIT %s""", (sample_size,))
+    jobs = [(row[0], row[1], blobs.file_text(row[2], row[3]))
+            for row in cur.fetchall()]
+
+    agree, nomos_only, fingerprint_only = compare_engines(jobs, batch_size)
+
+    shutil.rmtree(base_path)
+
+    print('Engines agree on %s of %s files' % (agree, len(jobs)))
+
+    for abbr in sorted(set(nomos_only.keys() + fingerprint_only.keys())):
+        print('%s: %s only found by nomos, %s only by fingerprint' % \
+                  (abbr, nomos_only.get(abbr, 0), fingerprint_only.get(abbr, 0)))
+
+
+def compare_engines(jobs, batch_size = 50):
+    # Scan (key, name, text) jobs with both engines. Returns the number
+    # they agree on and, by abbreviation, how often only nomos or only
+    # the fingerprint classifier found it.
+    agree = 0
+    nomos_only = {}
+    fingerprint_only = {}
+
+    for i in range(0, len(jobs), batch_size):
+        batch = jobs[i:i + batch_size]
+        nomos_found = scan_with_nomos(batch)
+        fingerprint_found = scan_with_fingerprint(batch)
+
+        for (license_id, n_found), (_, f_found) in zip(nomos_found,
+                                                       fingerprint_found):
+            n_found = set(rule_engine.normalize(n_found))
+            f_found = set(rule_engine.normalize(f_found))
+
+            if n_found == f_found:
+                agree = agree + 1
+            else:
+                logger.info("License file %s: nomos %s, fingerprint %s" % \
+                    (license_id, ", ".join(sorted(n_found)),
+                     ", ".join(sorted(f_found))))
+
+            for abbr in n_found - f_found:
+                nomos_only[abbr] = nomos_only.get(abbr, 0) + 1
+            for abbr in f_found - n_found:
+                fingerprint_only[abbr] = fingerprint_only.get(abbr, 0) + 1
+
+    return agree, nomos_only, fingerprint_only
 
 
 if __name__ == "__main__":
@@ -276,6 +912,58 @@ if __name__ == "__main__":
                       help="""Indicate which record to start processing with""",
                       default=0)
 
+    parser.add_option('-w', '--workers',
+                      action="store", dest="workers", type="int",
+                      help="""Number of nomos scans to run in parallel""",
+                      default=1)
+
+    parser.add_option('-b', '--batch_size',
+                      action="store", dest="batch_size", type="int",
+                      help="""Number of files to scan with each nomos
+                              process""",
+                      default=50)
+
+    parser.add_option('-e', '--engine',
+                      action="store", dest="engine",
+                      type="choice", choices=['nomos', 'fingerprint'],
+                      help="""Classifier to use: 'nomos' or 'fingerprint'
+                              (in-process n-gram matching against the
+                              reference_licenses_directory texts)""",
+                      default='nomos')
+
+    parser.add_option('-x', '--cross_check',
+                      action="store", dest="cross_check", type="int",
+                      help="""Compare nomos and fingerprint results on a
+                              random sample of this many license files""",
+                      default=0)
+
+    parser.add_option('--stats_file',
+                      action="store", dest="stats_file",
+                      help="""File to write counters and latency histograms
+                              to every minute (pool workers write
+                              <file>.<pid>)""",
+                      default="license_id_stats.json")
+
+    parser.add_option('--profile',
+                      action="store_true", dest="profile",
+                      help="""Dump cProfile data for each stage into the
+                              'profile' directory""",
+                      default=False)
+
+    parser.add_option('--build_canonical',
+                      action="store_true", dest="build_canonical",
+                      help="""Hash the reference_licenses_directory texts
+                              into the canonical_texts_file table used
+                              for exact matches""",
+                      default=False)
+
+    parser.add_option('--reanalyze_stale',
+                      action="store_true", dest="reanalyze_stale",
+                      help="""Re-normalize files whose results predate the
+                              current rules and rescan those not scanned
+                              by the current engine version""",
+                      default=False)
+
     parser.add_option('-a', '--map_repos_to_licenses',
                       action="store_true", dest="map_repos_to_licenses",
                       help="""Map repos to licenses""",
@@ -295,9 +983,38 @@ if __name__ == "__main__":
     logging.basicConfig(filename='license_id.log',level=logging.ERROR)
     logging.getLogger(__name__).setLevel(logging.DEBUG)
 
+    engine = options.engine
+    stats_file = options.stats_file
+
+    if stats_file:
+        metrics.start_flusher(stats_file)
+
+    if options.profile:
+        metrics.enable_profiling('profile')
+
+    if options.build_canonical:
+        canonical.build_table(config['reference_licenses_directory'],
+                              config['canonical_texts_file'])
+
+    canonical_table = canonical.load_table(config.get('canonical_texts_file'))
+
+    if engine == 'fingerprint' or options.cross_check:
+        load_classifier()
+
+    # Compare the two classifiers
+    if options.cross_check:
+        cross_check_engines(options.cross_check, options.batch_size)
+
     # Try to match license files against known strings
     if options.process_licenses:
-        process_licenses(int(options.start_with))
+        process_licenses(int(options.start_with), options.workers,
+                         options.batch_size)
+
+    # Bring results from older engine or rules versions up to date
+    if options.reanalyze_stale:
+        renormalize_stale()
+        process_licenses(int(options.start_with), options.workers,
+                         options.batch_size, stale_only=True)
 
     # Map repos to licenses
     if options.map_repos_to_licenses:
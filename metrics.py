@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# Counters, latency histograms and optional per-stage cProfile data for
+# the crawler and the analyzer, flushed periodically to a JSON stats file
+
+import os
+import json
+import time
+import atexit
+import bisect
+import pstats
+import cProfile
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0, float('inf')]
+
+lock = threading.Lock()
+counters = {}
+histograms = {}
+started = time.time()
+
+profile_path = None
+profiles = {}
+active_profiles = threading.local()
+
+
+def reset():
+    # Start over, e.g. in a freshly forked worker process
+    global started
+
+    with lock:
+        counters.clear()
+        histograms.clear()
+        profiles.clear()
+        started = time.time()
+
+
+def count(name, value=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    with lock:
+        if not name in histograms:
+            histograms[name] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                'buckets': [0] * len(BUCKETS)}
+
+        histogram = histograms[name]
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        histogram['max'] = max(histogram['max'], seconds)
+        histogram['buckets'][bisect.bisect_left(BUCKETS, seconds)] += 1
+
+
+class timer(object):
+    """
+    Times a block into the named histogram:
+
+        with metrics.timer('db.flush'):
+            writer.flush()
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.time() - self.start
+        observe(self.name, self.elapsed)
+        return False
+
+
+def snapshot():
+    with lock:
+        result = {'pid': os.getpid(),
+                  'uptime': time.time() - started,
+                  'counters': dict(counters),
+                  'histograms': {}}
+
+        for name in histograms:
+            histogram = histograms[name]
+            result['histograms'][name] = {
+                'count': histogram['count'],
+                'sum': histogram['sum'],
+                'max': histogram['max'],
+                'mean': histogram['sum'] / max(histogram['count'], 1),
+                'buckets': [[str(bound), n] for bound, n in
+                            zip(BUCKETS, histogram['buckets'])]}
+
+    return result
+
+
+def write_stats(path):
+    # Write to a temp file and rename so readers never see partial stats
+    tmp_path = "%s.tmp" % path
+
+    f = open(tmp_path, 'w')
+    f.write(json.dumps(snapshot(), indent=1, sort_keys=True))
+    f.close()
+
+    os.rename(tmp_path, path)
+
+
+def start_flusher(path, interval=60):
+    # Rewrite the stats file every `interval` seconds and at exit
+    def flush_forever():
+        while True:
+            time.sleep(interval)
+            write_stats(path)
+
+    thread = threading.Thread(target=flush_forever)
+    thread.daemon = True
+    thread.start()
+
+    atexit.register(write_stats, path)
+
+    return thread
+
+
+def enable_profiling(path):
+    # Profile each stage() block and dump one .prof file per stage at exit
+    global profile_path
+
+    profile_path = path
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    atexit.register(dump_profiles)
+
+
+class stage(object):
+    """
+    Marks a stage of work for --profile. Each thread gets its own
+    profiler per stage (cProfile only follows the thread that enabled
+    it), and nested stages are counted in the outermost one.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = None
+
+    def __enter__(self):
+        if profile_path and not getattr(active_profiles, 'active', False):
+            key = (self.name, threading.current_thread().ident)
+
+            with lock:
+                if not key in profiles:
+                    profiles[key] = cProfile.Profile()
+                self.profile = profiles[key]
+
+            active_profiles.active = True
+            self.profile.enable()
+
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile:
+            self.profile.disable()
+            active_profiles.active = False
+
+        return False
+
+
+def dump_profiles():
+    stages = {}
+
+    with lock:
+        for (name, ident), profile in profiles.items():
+            stages.setdefault(name, []).append(profile)
+
+    for name in stages:
+        stats = pstats.Stats(stages[name][0])
+
+        for profile in stages[name][1:]:
+            stats.add(profile)
+
+        stats.dump_stats(os.path.join(profile_path, "%s.%s.prof" % \
+                                          (name, os.getpid())))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Picks the license-relevant parts out of a README so only those go to
+# the classifier: sections under a license/copying heading (Markdown,
+# reStructuredText/setext underlines or HTML), SPDX-License-Identifier
+# lines and license badges. READMEs are read a line at a time, without
+# splitting the whole text up front.
+
+import re
+
+# Bump when what scan_text returns changes; it's part of license_id.py's
+# scan stamp, so READMEs are scanned again
+VERSION = 1
+
+readme_re = re.compile(r"readme(\.|$)", re.IGNORECASE)
+
+atx_heading_re = re.compile(r"^\s{0,3}(#{1,6})\s*(.*?)\s*#*\s*$")
+html_heading_re = re.compile(r"<h([1-6])[^>]*>(.*?)(</h[1-6]>|$)",
+                             re.IGNORECASE)
+underline_re = re.compile(r"^\s*([=\-~^*+])\1{2,}\s*$")
+fence_re = re.compile(r"^\s*(```|~~~)")
+line_re = re.compile(r"[^\r\n]*(\r\n|\r|\n)|[^\r\n]+")
+
+license_heading_re = re.compile(r"\b(licen[cs]es?|licensing|copying|"
+                                r"copyright|legal)\b", re.IGNORECASE)
+spdx_re = re.compile(r"SPDX-License-Identifier\s*:", re.IGNORECASE)
+badge_re = re.compile(r"(!\[[^\]]*licen[cs]e[^\]]*\]|"
+                      r"shields\.io/[^\s)\"']*licen[cs]e|"
+                      r"badge/licen[cs]e)", re.IGNORECASE)
+
+# Underline characters in the order a document typically uses them, for
+# ranking setext/reST headings
+UNDERLINE_LEVELS = "=-~^*+"
+
+
+def is_readme(name):
+    return bool(readme_re.match(name or ""))
+
+
+def heading(line, next_line):
+    # (level, text) if the line starts a heading, else None
+    m = atx_heading_re.match(line)
+
+    if m and line.lstrip().startswith('#'):
+        return len(m.group(1)), m.group(2)
+
+    m = html_heading_re.search(line)
+
+    if m:
+        return int(m.group(1)), m.group(2)
+
+    if line.strip() and next_line is not None and \
+            underline_re.match(next_line) and \
+            not underline_re.match(line):
+        return UNDERLINE_LEVELS.index(next_line.strip()[0]) + 1, line.strip()
+
+    return None
+
+
+def iter_lines(text):
+    # The lines of text with their line endings, as splitlines(True) would
+    # give them, one at a time
+    for m in line_re.finditer(text):
+        yield m.group(0)
+
+
+def license_spans(text):
+    # The license-relevant lines of a README joined together, or None if
+    # there aren't any
+    lines = iter_lines(text)
+    spans = []
+    section_level = None
+    in_fence = False
+    next_line = next(lines, None)
+
+    while next_line is not None:
+        line = next_line
+        next_line = next(lines, None)
+
+        if fence_re.match(line):
+            in_fence = not in_fence
+
+        found = None
+
+        if not in_fence:
+            found = heading(line, next_line)
+
+        if found:
+            level, title = found
+
+            # A heading at the same or a higher level ends the section
+            if section_level is not None and level <= section_level:
+                section_level = None
+
+            if section_level is None and license_heading_re.search(title):
+                section_level = level
+
+        if section_level is not None:
+            spans.append(line)
+        elif spdx_re.search(line) or badge_re.search(line):
+            spans.append(line)
+
+    if not spans:
+        return None
+
+    return "".join(spans)
+
+
+def scan_text(name, text):
+    # What to hand the classifier for a file: the license parts of a
+    # README when it has any, otherwise the whole file
+    if not is_readme(name):
+        return text
+
+    return license_spans(text) or text
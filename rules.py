@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Normalization of scanner output: one declarative table of aliases,
+# suppressions and implications, compiled once into a RuleEngine that the
+# analyzer uses to clean up raw license lists and the mapper uses to turn
+# abbreviations into ids in the licenses table
+
+import re
+
+# Bump whenever a change here changes what normalize() returns; stored
+# results are then re-normalized by license_id.py --reanalyze_stale
+VERSION = 1
+
+# Abbreviations rewritten to another; dropped instead if the list
+# already has the other
+ALIASES = {
+    # All "MIT" and "MIT-style" should just be "MIT"
+    'MIT-style': 'MIT',
+}
+
+# (abbreviation, what drops it). Triggers are exact abbreviations or
+# /patterns/ searched for in each abbreviation.
+SUPPRESSIONS = [
+    # "Public domain" match for Ruby, Artistic & GPL(s) are usually false
+    # positives
+    ('Public-domain', ['Ruby', 'Artistic', '/GPL/', '/Affero/']),
+
+    # "FSF" match for GPL not needed
+    ('FSF', ['/GPL/']),
+]
+
+# (abbreviation, abbreviations it implies), with the same triggers as
+# SUPPRESSIONS for the abbreviation
+IMPLICATIONS = []
+
+# Variants that map to their base license when the licenses table has it,
+# e.g. "BSD-style" to "BSD"
+VARIANT_PATTERN = r"^(.*)-(style|possibility)"
+
+# What a scanner reports when it found nothing; never mapped
+NO_LICENSE = 'No_license_found'
+
+
+def compile_trigger(triggers):
+    # One test for a list of triggers
+    exact = set([t for t in triggers if not t.startswith('/')])
+    patterns = [t[1:-1] for t in triggers if t.startswith('/')]
+    pattern_re = re.compile("|".join(patterns)) if patterns else None
+
+    def test(abbr):
+        return abbr in exact or bool(pattern_re and pattern_re.search(abbr))
+
+    return test
+
+
+class RuleEngine(object):
+    """
+    The rule tables compiled for repeated use. Facts about each distinct
+    abbreviation (its alias, which suppressions and implications it
+    triggers, what it maps to) are worked out once and cached, so a list
+    is normalized with a few set operations.
+    """
+
+    def __init__(self, aliases=ALIASES, suppressions=SUPPRESSIONS,
+                 implications=IMPLICATIONS, variant_pattern=VARIANT_PATTERN,
+                 license_ids=None):
+        self.aliases = dict(aliases)
+        self.suppressions = [(abbr, compile_trigger(triggers))
+                             for abbr, triggers in suppressions]
+        self.implications = [(implied, compile_trigger([abbr]))
+                             for abbr, implied in implications]
+        self.variant_re = re.compile(variant_pattern)
+        self.license_ids = license_ids or {}
+        self.facts = {}
+        self.ids = {}
+
+    def set_license_ids(self, license_ids):
+        # abbreviation -> id from the licenses table
+        self.license_ids = license_ids
+        self.ids = {}
+
+    def abbr_facts(self, abbr):
+        # (alias, abbreviations it suppresses, abbreviations it implies)
+        if not abbr in self.facts:
+            suppresses = frozenset([target for target, test in
+                                    self.suppressions if test(abbr)])
+            implies = []
+
+            for implied, test in self.implications:
+                if test(abbr):
+                    implies.extend(implied)
+
+            self.facts[abbr] = (self.aliases.get(abbr, abbr), suppresses,
+                                tuple(implies))
+
+        return self.facts[abbr]
+
+    def normalize(self, abbrs):
+        # The cleaned-up list, in the scanner's order without duplicates.
+        # Rules are all evaluated against the raw list.
+        present = set(abbrs)
+        suppressed = set()
+        implied = []
+
+        for abbr in abbrs:
+            alias, suppresses, implies = self.abbr_facts(abbr)
+            suppressed |= suppresses
+            implied.extend(implies)
+
+        result = []
+        seen = set()
+
+        for abbr in list(abbrs) + implied:
+            if abbr in suppressed:
+                continue
+
+            alias = self.abbr_facts(abbr)[0]
+
+            if alias != abbr and alias in present:
+                continue
+
+            if not alias in seen:
+                seen.add(alias)
+                result.append(alias)
+
+        return result
+
+    def normalize_batch(self, abbr_lists):
+        return [self.normalize(abbrs) for abbrs in abbr_lists]
+
+    def license_id(self, abbr):
+        # The licenses table id for a normalized abbreviation: its base
+        # license for a variant we know the base of, else its own entry,
+        # else None
+        if not abbr in self.ids:
+            m = self.variant_re.match(abbr)
+
+            if abbr == NO_LICENSE:
+                self.ids[abbr] = None
+            elif m and m.group(1) in self.license_ids:
+                self.ids[abbr] = self.license_ids[m.group(1)]
+            else:
+                self.ids[abbr] = self.license_ids.get(abbr)
+
+        return self.ids[abbr]
+
+    def license_id_set(self, abbrs):
+        # The distinct licenses a raw list maps to
+        return set([self.license_id(abbr) for abbr in
+                    self.normalize(abbrs)]) - set([None])
+
+    def map_abbrs(self, abbrs):
+        # abbreviation -> id (or None) for a batch of distinct
+        # abbreviations, leaving out NO_LICENSE
+        return dict([(abbr, self.license_id(abbr)) for abbr in abbrs
+                     if abbr != NO_LICENSE])
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# Versioned schema for the crawler and analysis databases. Each migration
+# is applied once, in order and in its own transaction; schema_migrations
+# records which ones a database has. Add new migrations to the end of
+# MIGRATIONS rather than editing applied ones.
+
+# Recompute the aggregate tables from scratch. They're kept up to date
+# incrementally by the crawler and map_repos_to_licenses, so this is only
+# needed when they're first created or after rows are deleted.
+REBUILD_AGGREGATES = [
+    """INSERT INTO repository_counts(fork, repos)
+       SELECT fork, COUNT(*)
+         FROM repositories
+        WHERE fork IS NOT NULL
+     GROUP BY fork
+       ON CONFLICT (fork) DO UPDATE
+               SET repos = EXCLUDED.repos,
+                   updated_at = now()""",
+
+    """INSERT INTO license_repo_counts(license_abbr_id, repos, fork_repos)
+       SELECT a.license_abbr_id, COUNT(*), COUNT(*) FILTER (WHERE r.fork)
+         FROM repository_license_abbr a
+         JOIN repositories r
+           ON r.id = a.repository_id
+     GROUP BY a.license_abbr_id
+       ON CONFLICT (license_abbr_id) DO UPDATE
+               SET repos = EXCLUDED.repos,
+                   fork_repos = EXCLUDED.fork_repos,
+                   updated_at = now()""",
+
+    """DELETE FROM license_repo_counts c
+        WHERE NOT EXISTS (SELECT 1 FROM repository_license_abbr a
+                           WHERE a.license_abbr_id = c.license_abbr_id)""",
+]
+
+# Advisory lock every transaction that draws from license_scan_changes
+# holds (shared) until it ends, so export.py can tell which change ids
+# can still turn up
+CHANGE_LOCK = 7200
+
+MIGRATIONS = [
+    (1, "Base tables", [
+        """CREATE TABLE IF NOT EXISTS repositories(id SERIAL PRIMARY KEY,
+                                gh_id INT UNIQUE,
+                                owner_login VARCHAR,
+                                name VARCHAR,
+                                full_name VARCHAR,
+                                description VARCHAR,
+                                private BOOLEAN,
+                                fork BOOLEAN,
+                                api_url VARCHAR,
+                                html_url VARCHAR)""",
+
+        """CREATE TABLE IF NOT EXISTS repository_licenses(id SERIAL PRIMARY KEY,
+                                repository_id INT REFERENCES
+                                                  repositories (gh_id),
+                                type VARCHAR,
+                                encoding VARCHAR,
+                                api_url VARCHAR,
+                                html_url VARCHAR,
+                                size INT,
+                                name VARCHAR,
+                                path VARCHAR,
+                                content TEXT,
+                                sha VARCHAR)""",
+
+        # License file bodies, decoded and zlib-compressed, once per git
+        # SHA. They're already compressed, so keep TOAST from trying again.
+        """CREATE TABLE IF NOT EXISTS license_blobs(sha VARCHAR PRIMARY KEY,
+                                size INT,
+                                content BYTEA)""",
+
+        """ALTER TABLE license_blobs
+             ALTER COLUMN content SET STORAGE EXTERNAL""",
+
+        """CREATE TABLE IF NOT EXISTS license_metadata(id SERIAL PRIMARY KEY,
+                                license_id INT REFERENCES
+                                               repository_licenses (id),
+                                is_primary BOOLEAN DEFAULT FALSE,
+                                license_abbr VARCHAR,
+                                UNIQUE(license_id, license_abbr))""",
+
+        # The raw scanner output behind each file's license_metadata rows
+        # and the engine and normalization rules versions that produced
+        # them
+        """CREATE TABLE IF NOT EXISTS license_scans(license_id INT PRIMARY KEY REFERENCES
+                                               repository_licenses (id),
+                                engine VARCHAR,
+                                engine_version VARCHAR,
+                                rules_version INT,
+                                raw_licenses VARCHAR[],
+                                scanned_at TIMESTAMP DEFAULT now())""",
+
+        """CREATE INDEX IF NOT EXISTS license_scans_stamp
+                     ON license_scans (engine, engine_version,
+                                       rules_version)""",
+
+        # The master list of license abbreviations repos are mapped to
+        """CREATE TABLE IF NOT EXISTS licenses(id SERIAL PRIMARY KEY,
+                                license_abbr VARCHAR UNIQUE,
+                                name VARCHAR)""",
+
+        """CREATE TABLE IF NOT EXISTS repository_license_abbr(repository_id INT REFERENCES
+                                               repositories(id),
+                                license_abbr_id INT REFERENCES
+                                                licenses(id),
+                                UNIQUE(repository_id, license_abbr_id))""",
+
+        """CREATE INDEX IF NOT EXISTS repository_licenses_sha
+                     ON repository_licenses (sha)""",
+
+        """CREATE TABLE IF NOT EXISTS crawl_state(
+                                name VARCHAR PRIMARY KEY,
+                                next_url VARCHAR,
+                                last_id INT,
+                                updated_at TIMESTAMP DEFAULT now())""",
+
+        """CREATE TABLE IF NOT EXISTS crawl_repo_status(
+                                repository_id INT PRIMARY KEY REFERENCES
+                                                  repositories (gh_id),
+                                status VARCHAR,
+                                attempts INT DEFAULT 1,
+                                updated_at TIMESTAMP DEFAULT now())""",
+
+        """CREATE TABLE IF NOT EXISTS crawl_shards(id SERIAL PRIMARY KEY,
+                                start_id INT UNIQUE,
+                                end_id INT,
+                                next_since INT,
+                                status VARCHAR DEFAULT 'pending',
+                                worker VARCHAR,
+                                updated_at TIMESTAMP DEFAULT now())""",
+
+        """CREATE INDEX IF NOT EXISTS crawl_shards_status
+                     ON crawl_shards (status, start_id)""",
+    ]),
+
+    # license_metadata.license_id is already covered by the
+    # UNIQUE(license_id, license_abbr) index. Only non-forks are analyzed,
+    # so a partial index in id order serves both the fork filter and the
+    # keyset paging of process_licenses.
+    (2, "Indexes for the analysis joins", [
+        """CREATE INDEX IF NOT EXISTS repository_licenses_repository_id
+                     ON repository_licenses (repository_id)""",
+
+        """CREATE INDEX IF NOT EXISTS repositories_non_fork
+                     ON repositories (id) WHERE fork = 'f'""",
+
+        """CREATE INDEX IF NOT EXISTS repository_license_abbr_license
+                     ON repository_license_abbr (license_abbr_id)""",
+    ]),
+
+    (3, "Aggregate tables", [
+        """CREATE TABLE IF NOT EXISTS repository_counts(fork BOOLEAN PRIMARY KEY,
+                                repos BIGINT DEFAULT 0,
+                                updated_at TIMESTAMP DEFAULT now())""",
+
+        """CREATE TABLE IF NOT EXISTS license_repo_counts(license_abbr_id INT PRIMARY KEY
+                                                REFERENCES licenses(id),
+                                repos BIGINT DEFAULT 0,
+                                fork_repos BIGINT DEFAULT 0,
+                                updated_at TIMESTAMP DEFAULT now())""",
+    ] + REBUILD_AGGREGATES),
+
+    # A key export.py can resume --incremental exports from
+    (4, "Ids for repository_license_abbr", [
+        """ALTER TABLE repository_license_abbr
+             ADD COLUMN IF NOT EXISTS id BIGSERIAL PRIMARY KEY""",
+    ]),
+
+    # ghretrieve.py --refresh re-checks repos least recently checked
+    # first (never-checked ones, NULL, before all others) and marks
+    # license files that have gone from a repo rather than deleting them
+    (5, "Refresh tracking", [
+        """ALTER TABLE repositories
+             ADD COLUMN IF NOT EXISTS checked_at TIMESTAMP""",
+
+        """ALTER TABLE repositories
+             ALTER COLUMN checked_at SET DEFAULT now()""",
+
+        """CREATE INDEX IF NOT EXISTS repositories_checked_at
+                     ON repositories (checked_at NULLS FIRST, gh_id)""",
+
+        """ALTER TABLE repository_licenses
+             ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP""",
+    ]),
+
+    # A repo's files are stored once per path, so storing a repo's files
+    # again is a no-op. Copies left by earlier re-fetches are dropped
+    # first, keeping the oldest, along with their analysis results.
+    (6, "One row per repository license file", [
+        """CREATE TEMPORARY TABLE duplicate_licenses AS
+           SELECT id FROM (SELECT id, row_number() OVER (
+                                      PARTITION BY repository_id, path
+                                          ORDER BY id) AS n
+                             FROM repository_licenses) l
+            WHERE n > 1""",
+
+        """DELETE FROM license_metadata
+            WHERE license_id IN (SELECT id FROM duplicate_licenses)""",
+
+        """DELETE FROM license_scans
+            WHERE license_id IN (SELECT id FROM duplicate_licenses)""",
+
+        """DELETE FROM repository_licenses
+            WHERE id IN (SELECT id FROM duplicate_licenses)""",
+
+        """DROP TABLE duplicate_licenses""",
+
+        """CREATE UNIQUE INDEX IF NOT EXISTS repository_licenses_repository_path
+                     ON repository_licenses (repository_id, path)""",
+    ]),
+
+    # Serial ids of license_metadata rows aren't stable, so export.py
+    # --incremental follows each file's results by a number drawn when
+    # they're first stored and whenever they change
+    (7, "Change ids for scan results", [
+        """CREATE SEQUENCE IF NOT EXISTS license_scan_changes""",
+
+        """ALTER TABLE license_scans
+             ADD COLUMN IF NOT EXISTS change_id BIGINT
+                 DEFAULT nextval('license_scan_changes')""",
+
+        """CREATE INDEX IF NOT EXISTS license_scans_change_id
+                     ON license_scans (change_id)""",
+    ]),
+]
+
+
+def applied_versions(db_conn):
+    cur = db_conn.cursor()
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS schema_migrations(
+                                version INT PRIMARY KEY,
+                                description VARCHAR,
+                                applied_at TIMESTAMP DEFAULT now())""")
+    cur.execute("""SELECT version FROM schema_migrations""")
+    versions = set([row[0] for row in cur.fetchall()])
+    db_conn.commit()
+
+    return versions
+
+
+def migrate(db_conn):
+    # Apply the migrations this database doesn't have yet and return
+    # their versions
+    cur = db_conn.cursor()
+    done = applied_versions(db_conn)
+    applied = []
+
+    for version, description, statements in MIGRATIONS:
+        if version in done:
+            continue
+
+        for statement in statements:
+            cur.execute(statement)
+
+        cur.execute("""INSERT INTO schema_migrations(version, description)
+                            VALUES (%s, %s)""", (version, description))
+        db_conn.commit()
+
+        applied.append(version)
+
+    return applied
+
+
+def rebuild_aggregates(db_conn):
+    cur = db_conn.cursor()
+
+    for statement in REBUILD_AGGREGATES:
+        cur.execute(statement)
+
+    db_conn.commit()
+
+
+def lock_changes(cur):
+    # Call in a transaction before it draws change ids
+    cur.execute("""SELECT pg_advisory_xact_lock_shared(%s)""",
+                (CHANGE_LOCK,))
+
+
+def committed_changes(db_conn):
+    # The last change id drawn so far. Waits for the transactions that
+    # drew ids to end, so no change at or below it can commit later.
+    cur = db_conn.cursor()
+
+    cur.execute("""SELECT pg_advisory_xact_lock(%s)""", (CHANGE_LOCK,))
+    cur.execute("""SELECT last_value, is_called FROM license_scan_changes""")
+    last_value, is_called = cur.fetchone()
+    db_conn.commit()
+
+    return last_value if is_called else 0
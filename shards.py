@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Splits the repository id space into shards in the crawl_shards table so
+# crawler processes on any number of hosts can work through it in
+# parallel
+
+import socket
+import os
+
+# A running shard that hasn't made progress for this long is assumed to
+# belong to a dead worker and can be claimed again. It has to outlast a
+# wait for the rate limit to reset (up to an hour), when a live worker
+# makes no progress.
+LEASE_TIMEOUT = '90 minutes'
+
+
+class ShardLost(Exception):
+    # Another worker claimed the shard after our lease ran out
+    pass
+
+
+def worker_name():
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+def create_shards(db_conn, start_id, end_id, shard_size):
+    # Add shards covering ids (start_id, end_id]; ranges that are already
+    # sharded are left alone
+    cur = db_conn.cursor()
+    created = 0
+
+    for since in range(start_id, end_id, shard_size):
+        cur.execute("""
+            INSERT INTO crawl_shards(start_id, end_id, next_since)
+                 VALUES (%s, %s, %s)
+            ON CONFLICT (start_id) DO NOTHING
+            """, (since, min(since + shard_size, end_id), since))
+        created += cur.rowcount
+
+    db_conn.commit()
+
+    return created
+
+
+def claim_shard(db_conn, worker):
+    # Take the lowest pending (or abandoned) shard. SKIP LOCKED lets many
+    # workers claim at once without waiting on each other.
+    cur = db_conn.cursor()
+
+    cur.execute("""
+        UPDATE crawl_shards
+           SET status = 'running', worker = %s, updated_at = now()
+         WHERE id = (SELECT id FROM crawl_shards
+                      WHERE status = 'pending'
+                         OR (status = 'running'
+                             AND updated_at < now() - interval %s)
+                   ORDER BY start_id
+                      LIMIT 1
+                        FOR UPDATE SKIP LOCKED)
+     RETURNING id, start_id, end_id, next_since
+        """, (worker, LEASE_TIMEOUT))
+
+    shard = cur.fetchone()
+    db_conn.commit()
+
+    return shard
+
+
+def shard_progress(db_conn):
+    cur = db_conn.cursor()
+    cur.execute("""SELECT status, COUNT(*) FROM crawl_shards
+                 GROUP BY status""")
+    progress = dict(cur.fetchall())
+    db_conn.commit()
+
+    return progress